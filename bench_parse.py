@@ -0,0 +1,68 @@
+## Times extract_feats end to end (parse, extractors and design matrix) with
+## ET.parse against the streaming backends of fastparse.py on the traces of a
+## directory, and checks they all come up with the same matrix. ET.parse alone
+## is timed too, to show how much of the etree run is parsing at all.
+##
+##   python bench_parse.py train [max_files] [repeats]
+
+import os
+import sys
+import time
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+import fastparse
+from extractors import ffs
+
+def best_time(run, repeats):
+    """
+    returns the best time over repeats of run(), and what its last call
+    returned
+    """
+    best = None
+    for _ in xrange(repeats):
+        start = time.time()
+        result = run()
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+def same_matrix(a, b):
+    X_a, feat_dict_a = a[:2]
+    X_b, feat_dict_b = b[:2]
+    return feat_dict_a == feat_dict_b and (X_a != X_b).nnz == 0
+
+def main(argv):
+    from classifier import extract_feats
+    direc = argv[1] if len(argv) > 1 else "train"
+    max_files = int(argv[2]) if len(argv) > 2 else None
+    repeats = int(argv[3]) if len(argv) > 3 else 3
+    files = sorted(os.listdir(direc))[:max_files]
+    paths = [os.path.join(direc, f) for f in files]
+    megabytes = sum(os.path.getsize(path) for path in paths) / float(1 << 20)
+    if not fastparse.streamable(ffs):
+        print "Some extractors need the whole tree, so only ET.parse can be used"
+        return 1
+
+    print "%d files, %.1f MB, best of %d" % (len(paths), megabytes, repeats)
+    parse, _ = best_time(lambda: [ET.parse(path) for path in paths], repeats)
+    base, expected = best_time(lambda: extract_feats(ffs, direc, files=files), repeats)
+    print "%-8s %9s %9s %8s %6s" % ("parser", "seconds", "MB/s", "speedup", "same")
+    print "%-8s %9.3f %9.1f %8.2f %6s" % ("etree", base, megabytes / base, 1.0, "-")
+    ok = True
+    for backend in fastparse.BACKENDS:
+        if not fastparse.available(backend):
+            print "%-8s not installed" % backend
+            continue
+        seconds, result = best_time(
+            lambda: extract_feats(ffs, direc, files=files, parser=backend), repeats)
+        same = same_matrix(result, expected)
+        ok = ok and same
+        print "%-8s %9.3f %9.1f %8.2f %6s" % (backend, seconds, megabytes / seconds,
+                                             base / seconds, same)
+    print "ET.parse alone took %.3fs, %.0f%% of the etree extraction" % (parse, 100 * parse / base)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,288 @@
+## Regression benchmark
+## --------------------
+## Runs the whole pipeline (extraction, feature selection and transform,
+## fitting the logistic and forest wrappers, prediction) on a fixed corpus and
+## checks it against a stored baseline, so a change that makes extraction
+## slower or a model less accurate gets caught.
+##
+## The corpus is synthetic traces generated from a pinned seed, plus, if a
+## directory of real traces is given, the first SAMPLE_FILES of those (in
+## sorted order). The holdout split and the models are seeded too, so the
+## accuracies only move when the code does.
+##
+## Recorded for each run: wall time of every stage, how long a fixed
+## calibration loop takes in the same process (the mean of a run before the
+## pipeline and one after it), peak memory and how much it grew
+## over the run, and holdout accuracy and macro-F1 of each model. Stage times
+## are compared relative to the calibration loop, so a machine that is twice as
+## slow is allowed twice the time; memory is compared as growth over the
+## process's size before the run, which leaves out the interpreter and
+## libraries. A metric regresses when, with speed = calibration_seconds /
+## baseline calibration_seconds,
+##   seconds.*     > speed * (baseline * (1 + seconds tolerance) + SECONDS_SLACK)
+##   rss_growth_mb > baseline * (1 + memory tolerance) + MEMORY_SLACK_MB
+##   accuracy.*, macro_f1.* < baseline - accuracy tolerance
+##
+## That only evens out raw speed, not cache sizes, allocators or library
+## builds, so the baseline belongs to the machine it was recorded on: run
+## "update" on a machine before using "run" there as a gate ("run" warns when
+## the baseline came from elsewhere).
+##
+##   python benchmark.py update [benchmark_baseline.json] [sample_dir]
+##   python benchmark.py run [benchmark_baseline.json] [sample_dir]
+## "run" exits with 1 if anything regressed (2 if there is no baseline).
+
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+import numpy as np
+import calibration
+import evaluation
+import profiling
+import selection
+import transforms
+import util
+
+SEED = 181
+NUM_TRACES = 240
+SAMPLE_FILES = 50
+SECONDS_SLACK = 0.05
+MEMORY_SLACK_MB = 10.0
+CALIBRATION_REPEATS = 5
+DEFAULT_TOLERANCES = {
+    "seconds": 0.5,
+    "memory": 0.25,
+    "accuracy": 0.02,
+}
+
+SYSCALLS = ["load_image", "load_dll", "open_key", "query_value", "set_value",
+            "create_file", "open_file", "delete_file", "connect",
+            "get_host_by_name", "open_url", "create_thread", "vm_protect",
+            "create_process", "sleep", "enum_processes", "get_file_attributes"]
+# share of each trace's calls drawn from its class's own mix; the rest come
+# from a mix shared by every class, so the classes overlap
+CLASS_SIGNAL = 0.15
+BENCH_CLASSES = [8, 8, 8, 8, 10, 10, 12, 0, 1, 5, 14]
+
+def _call_attrs(call, clazz, rng):
+    # only some arguments give the class away
+    if rng.random() > CLASS_SIGNAL:
+        clazz = rng.choice(BENCH_CLASSES)
+    if call == "load_dll":
+        return 'filename="C:\\WINDOWS\\system32\\lib%d.dll"' % rng.randint(0, 30)
+    if call in ("open_key", "query_value", "set_value"):
+        return 'key="HKEY_LOCAL_MACHINE\\Software\\Vendor%d\\Key%d" value="v%d"' % (
+            clazz, rng.randint(0, 5), rng.randint(0, 3))
+    if call in ("create_file", "open_file", "delete_file"):
+        return 'srcfile="c:\\windows\\temp\\f%d.%s"' % (
+            rng.randint(0, 20), rng.choice(["tmp", "exe", "dll", "log"]))
+    if call == "connect":
+        return 'host="10.0.%d.%d" port="%d"' % (clazz, rng.randint(0, 9), rng.choice([80, 443, 8080]))
+    if call == "get_host_by_name":
+        return 'hostname="host%d.example.com"' % clazz
+    if call == "open_url":
+        return 'url="http://www.site%d.com/p%d?q=1"' % (clazz, rng.randint(0, 3))
+    return ""
+
+def synthetic_trace(clazz, rng):
+    """
+    The xml text of a made-up trace of the given class
+    """
+    class_rng = random.Random(clazz)
+    own_calls = class_rng.sample(SYSCALLS, 6)
+    out = ['<?xml version="1.0"?>', "<processes>"]
+    num_procs = rng.choice([1, 1, 2, 3, 5])
+    for p in xrange(num_procs):
+        out.append('<process index="%d" pid="%d" filename="c:\\prog%d.exe" parentindex="%d" '
+                   'starttime="00:%02d.000" terminationtime="00:%02d.000" startreason="%s">' % (
+                       p + 1, 1000 + p, rng.randint(0, 99), rng.randint(0, p), p, p + 10,
+                       "AnalysisTarget" if p == 0 else "CreateProcess"))
+        for thread in xrange(rng.randint(1, 3)):
+            out.append('<thread tid="%d">' % (2000 + 10 * p + thread))
+            out.append("<all_section>")
+            for _ in xrange(rng.randint(10, 150)):
+                pool = own_calls if rng.random() < CLASS_SIGNAL else SYSCALLS
+                call = rng.choice(pool)
+                out.append("<%s %s/>" % (call, _call_attrs(call, clazz, rng)))
+            out.append("</all_section>")
+            out.append("</thread>")
+        out.append("</process>")
+    out.append("</processes>")
+    return "\n".join(out)
+
+def make_corpus(direc, num_traces=NUM_TRACES, seed=SEED, sample_dir=None):
+    """
+    Writes num_traces synthetic traces into direc, named like the real ones,
+    and copies in the first SAMPLE_FILES traces of sample_dir if given
+    """
+    rng = random.Random(seed)
+    if not os.path.isdir(direc):
+        os.makedirs(direc)
+    for _ in xrange(num_traces):
+        clazz = rng.choice(BENCH_CLASSES)
+        name = "%040x.%s.xml" % (rng.getrandbits(160), util.malware_classes[clazz])
+        with open(os.path.join(direc, name), "w") as out:
+            out.write(synthetic_trace(clazz, rng))
+    if sample_dir is not None:
+        for datafile in sorted(os.listdir(sample_dir))[:SAMPLE_FILES]:
+            shutil.copy(os.path.join(sample_dir, datafile), direc)
+
+def calibration_loop():
+    """
+    Seconds taken by a fixed mix of the work the pipeline does (counting
+    strings in dicts, sorting and summing arrays); the best of a few runs
+    """
+    best = None
+    for _ in xrange(CALIBRATION_REPEATS):
+        start = time.time()
+        counts = Counter()
+        for i in xrange(100000):
+            counts["call%d" % (i % 97)] += 1
+        values = np.random.RandomState(0).rand(200000)
+        np.sort(values).cumsum()
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def machine():
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(), "node": platform.node()}
+
+def run_pipeline(direc, seed=SEED):
+    """
+    Runs extraction, selection and transform, fitting and prediction on the
+    traces in direc under the profiler. returns the flat dict of metrics.
+    """
+    from classifier import extract_feats, sk_logistic
+    from randomforest_classifier import sk_random_forest
+    from extractors import ffs
+
+    calibration_before = calibration_loop()
+    rss_start_kb, _ = profiling.read_rss()
+    profiling.start(trace_frames=0)
+    try:
+        with profiling.stage("extract_feats"):
+            X, feat_dict, t, ids = extract_feats(ffs, direc)
+        fit_rows, held = calibration.stratified_holdout(t, 0.25, seed)
+        with profiling.stage("select_transform"):
+            selector = selection.FeatureSelector(k=10000).fit(X[fit_rows], t[fit_rows])
+            X = selector.transform(X)
+            feature_transform = transforms.FeatureTransform().fit(X[fit_rows])
+            X = feature_transform.transform(X)
+        models = {}
+        with profiling.stage("fit_logistic"):
+            _, models["logistic"] = sk_logistic(X[fit_rows], t[fit_rows])
+        # the forest wrapper draws from numpy's global generator
+        np.random.seed(seed)
+        with profiling.stage("fit_forest"):
+            _, models["forest"] = sk_random_forest(X[fit_rows], t[fit_rows], num_trees=50)
+        preds = {}
+        with profiling.stage("predict"):
+            for name, model in models.items():
+                preds[name] = model.predict(X[held])
+    finally:
+        report = profiling.stop()
+    # the machine's speed can drift during the run, so it is bracketed
+    calibration_seconds = (calibration_before + calibration_loop()) / 2.0
+
+    metrics = {"peak_rss_mb": report["final_peak_rss_kb"] / 1024.0,
+               "rss_growth_mb": (report["final_peak_rss_kb"] - rss_start_kb) / 1024.0,
+               "calibration_seconds": calibration_seconds,
+               "rows": X.shape[0], "features": len(feat_dict)}
+    for name, stats in report["stages"].items():
+        metrics["seconds." + name] = stats["seconds"]
+    for name in sorted(preds):
+        scores = evaluation.evaluate(t[held], preds[name])
+        metrics["accuracy." + name] = scores["accuracy"]
+        metrics["macro_f1." + name] = scores["macro_f1"]
+    return metrics
+
+def compare(metrics, baseline, tolerances):
+    """
+    returns a list of (metric, value, baseline value, limit) for every metric
+    that regressed
+    """
+    speed = 1.0
+    if metrics.get("calibration_seconds") and baseline.get("calibration_seconds"):
+        speed = metrics["calibration_seconds"] / baseline["calibration_seconds"]
+    regressions = []
+    for name, base in sorted(baseline.items()):
+        if name not in metrics:
+            continue
+        value = metrics[name]
+        if name.startswith("seconds."):
+            limit = speed * (base * (1 + tolerances["seconds"]) + SECONDS_SLACK)
+            bad = value > limit
+        elif name == "rss_growth_mb":
+            limit = base * (1 + tolerances["memory"]) + MEMORY_SLACK_MB
+            bad = value > limit
+        elif name.startswith("accuracy.") or name.startswith("macro_f1."):
+            limit = base - tolerances["accuracy"]
+            bad = value < limit
+        else:
+            continue
+        if bad:
+            regressions.append((name, value, base, limit))
+    return regressions
+
+def print_metrics(metrics, baseline=None):
+    print "%-24s %12s %12s" % ("metric", "value", "baseline")
+    for name in sorted(metrics):
+        base = baseline.get(name) if baseline else None
+        print "%-24s %12.4f %12s" % (name, metrics[name],
+                                     "-" if base is None else "%.4f" % base)
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else "run"
+    baseline_path = argv[2] if len(argv) > 2 else "benchmark_baseline.json"
+    sample_dir = argv[3] if len(argv) > 3 else None
+    if command not in ("run", "update"):
+        print "usage: python benchmark.py run|update [baseline.json] [sample_dir]"
+        return 2
+
+    work_dir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        corpus = os.path.join(work_dir, "train")
+        make_corpus(corpus, sample_dir=sample_dir)
+        metrics = run_pipeline(corpus)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if command == "update":
+        with open(baseline_path, "w") as out:
+            json.dump({"metrics": metrics, "tolerances": DEFAULT_TOLERANCES,
+                       "seed": SEED, "num_traces": NUM_TRACES,
+                       "sample_dir": sample_dir, "machine": machine()},
+                      out, indent=2, sort_keys=True)
+        print_metrics(metrics)
+        print "Wrote baseline to %s" % baseline_path
+        return 0
+
+    if not os.path.exists(baseline_path):
+        print_metrics(metrics)
+        print "No baseline at %s; run 'python benchmark.py update' first" % baseline_path
+        return 2
+    with open(baseline_path) as f:
+        stored = json.load(f)
+    tolerances = dict(DEFAULT_TOLERANCES, **stored.get("tolerances", {}))
+    if stored.get("machine") != machine():
+        print ("Warning: %s was recorded on another machine; times are scaled by the "
+               "calibration loop, but run 'python benchmark.py update' here before "
+               "relying on this check" % baseline_path)
+    print_metrics(metrics, stored["metrics"])
+    regressions = compare(metrics, stored["metrics"], tolerances)
+    for name, value, base, limit in regressions:
+        print "REGRESSION %s: %.4f (baseline %.4f, limit %.4f)" % (name, value, base, limit)
+    if regressions:
+        return 1
+    print "No regressions"
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,131 @@
+## Calibration
+## -----------
+## A forest's vote fractions and a heavily regularized logistic regression's
+## probabilities are both poor estimates of how likely a prediction is to be
+## right, which matters as soon as anything thresholds on them (see
+## cascade.py). A calibrator is fitted on held-out probabilities and maps raw
+## probabilities to calibrated ones:
+##
+##   TemperatureScaler  - divides the log probabilities by one temperature,
+##                        fitted to minimize the held-out log loss. Keeps the
+##                        ranking of the classes, so argmax predictions don't
+##                        change.
+##   IsotonicCalibrator - fits a monotone map per class (one vs rest) and
+##                        renormalizes. More flexible, needs more held-out rows.
+##
+## CalibratedModel bundles a model with its calibrator, so pickling the model
+## keeps its calibration with it.
+
+import numpy as np
+from scipy.optimize import minimize_scalar
+from sklearn.isotonic import IsotonicRegression
+import util
+
+EPS = 1e-12
+
+def stratified_holdout(t, fraction=0.2, random_state=0):
+    """
+    returns the sorted positions of the rows to fit on and of the rows to
+    hold out: about fraction of each class, and none of classes with a
+    single row
+    """
+    t = np.asarray(t)
+    rng = np.random.RandomState(random_state)
+    held = []
+    for clazz in np.unique(t):
+        rows = np.flatnonzero(t == clazz)
+        if len(rows) > 1:
+            n_held = min(len(rows) - 1, max(1, int(round(fraction * len(rows)))))
+            held.append(rng.choice(rows, n_held, replace=False))
+    held = np.sort(np.concatenate(held)) if held else np.array([], dtype=int)
+    fit_rows = np.setdiff1d(np.arange(len(t)), held)
+    return fit_rows, held
+
+def softmax(logits):
+    logits = logits - logits.max(axis=1)[:, np.newaxis]
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1)[:, np.newaxis]
+
+class TemperatureScaler(object):
+    def fit(self, probas, t):
+        logits = np.log(probas + EPS)
+        rows = np.arange(len(t))
+        def log_loss(log_temp):
+            scaled = logits / np.exp(log_temp)
+            scaled = scaled - scaled.max(axis=1)[:, np.newaxis]
+            log_norm = np.log(np.exp(scaled).sum(axis=1))
+            return (log_norm - scaled[rows, t]).mean()
+        result = minimize_scalar(log_loss, bounds=(-5.0, 5.0), method="bounded")
+        self.temperature_ = float(np.exp(result.x))
+        return self
+
+    def transform(self, probas):
+        return softmax(np.log(probas + EPS) / self.temperature_)
+
+class IsotonicCalibrator(object):
+    def fit(self, probas, t):
+        t = np.asarray(t)
+        self.maps_ = []
+        for clazz in xrange(probas.shape[1]):
+            if (t == clazz).any():
+                iso = IsotonicRegression(y_min=0.0, y_max=1.0, out_of_bounds="clip")
+                iso.fit(probas[:, clazz], (t == clazz).astype(float))
+                self.maps_.append(iso)
+            else:
+                # never seen in the holdout, leave the model's own estimate
+                self.maps_.append(None)
+        return self
+
+    def transform(self, probas):
+        out = np.empty_like(probas)
+        for clazz, iso in enumerate(self.maps_):
+            out[:, clazz] = probas[:, clazz] if iso is None else iso.predict(probas[:, clazz])
+        totals = out.sum(axis=1)
+        # rows every map sent to 0 keep their raw probabilities
+        empty = totals <= 0
+        out[empty] = probas[empty]
+        totals[empty] = probas[empty].sum(axis=1)
+        return out / totals[:, np.newaxis]
+
+calibrators = {
+    "temperature": TemperatureScaler,
+    "isotonic": IsotonicCalibrator,
+}
+
+class CalibratedModel(object):
+    """
+    arguments:
+      model is a classifier with fit and predict_proba
+      method is "temperature" or "isotonic"
+      holdout is the fraction of each class held out of the model's training
+        data to fit the calibrator on
+      prefit means model is already fitted: fit then only fits the
+        calibrator, on all the rows it is given
+    """
+    def __init__(self, model, method="temperature", holdout=0.2, prefit=False,
+                 random_state=0):
+        if method not in calibrators:
+            raise ValueError("Unknown calibration method: %s" % method)
+        self.model = model
+        self.method = method
+        self.holdout = holdout
+        self.prefit = prefit
+        self.random_state = random_state
+
+    def fit(self, X, t):
+        t = np.asarray(t)
+        if self.prefit:
+            calib_rows = np.arange(len(t))
+        else:
+            fit_rows, calib_rows = stratified_holdout(t, self.holdout, self.random_state)
+            self.model.fit(X[fit_rows], t[fit_rows])
+        probas = util.full_probas(self.model, self.model.predict_proba(X[calib_rows]))
+        self.calibrator_ = calibrators[self.method]().fit(probas, t[calib_rows])
+        return self
+
+    def predict_proba(self, X):
+        probas = util.full_probas(self.model, self.model.predict_proba(X))
+        return self.calibrator_.transform(probas)
+
+    def predict(self, X):
+        return np.argmax(self.predict_proba(X), axis=1)
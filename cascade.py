@@ -0,0 +1,89 @@
+## Cascaded prediction
+## -------------------
+## Most traces are easy: a logistic regression on nothing but how often each
+## syscall was made gets them right, and is far cheaper to run than a big
+## forest on every feature. CascadeClassifier asks the cheap model first and
+## keeps its answer whenever its (calibrated) top probability is at least
+## threshold; only the remaining rows are sent on to the expensive model.
+##
+## tune_threshold picks the lowest threshold that loses no more than max_drop
+## accuracy against the expensive model alone on held-out rows, so the cheap
+## model answers as many rows as it safely can.
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from calibration import CalibratedModel
+from extractors import SYSCALL_PREFIX
+import util
+
+def unigram_columns(feat_dict):
+    """
+    The columns of the plain syscall counts (syscall_count's features, named
+    SYSCALL_PREFIX + call)
+    """
+    columns = sorted(col for feat, col in feat_dict.iteritems()
+                     if feat.startswith(SYSCALL_PREFIX))
+    if not columns:
+        raise ValueError("No syscall count features in this vocabulary")
+    return np.array(columns, dtype=int)
+
+class CascadeClassifier(object):
+    """
+    arguments:
+      expensive is the classifier that answers the rows the cheap one isn't
+        sure about
+      columns are the columns of X the cheap model sees (say unigram_columns)
+      cheap is the cheap classifier; defaults to a temperature-calibrated
+        logistic regression
+      threshold is the top probability above which the cheap answer is kept
+    """
+    def __init__(self, expensive, columns, cheap=None, threshold=0.9):
+        self.expensive = expensive
+        self.columns = columns
+        if cheap is None:
+            cheap = CalibratedModel(LogisticRegression(C=0.01), method="temperature")
+        self.cheap = cheap
+        self.threshold = threshold
+
+    def fit(self, X, t):
+        self.cheap.fit(X[:, self.columns], t)
+        self.expensive.fit(X, t)
+        return self
+
+    def _cascade(self, X, threshold):
+        probas = util.full_probas(self.cheap, self.cheap.predict_proba(X[:, self.columns]))
+        unsure = np.flatnonzero(probas.max(axis=1) < threshold)
+        if len(unsure):
+            probas[unsure] = util.full_probas(self.expensive,
+                                              self.expensive.predict_proba(X[unsure]))
+        # the share of rows the cheap model answered, for reporting
+        self.exit_rate_ = 1.0 - len(unsure) / float(max(1, X.shape[0]))
+        return probas
+
+    def predict_proba(self, X):
+        return self._cascade(X, self.threshold)
+
+    def predict(self, X):
+        return np.argmax(self.predict_proba(X), axis=1)
+
+    def tune_threshold(self, X, t, max_drop=0.0,
+                       candidates=(0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99)):
+        """
+        Sets threshold to the lowest candidate whose cascade accuracy on the
+        held-out rows X, t is within max_drop of the expensive model's, and
+        returns it (1.0, never trusting the cheap model, if none is)
+        """
+        t = np.asarray(t)
+        cheap = util.full_probas(self.cheap, self.cheap.predict_proba(X[:, self.columns]))
+        expensive = util.full_probas(self.expensive, self.expensive.predict_proba(X))
+        cheap_right = np.argmax(cheap, axis=1) == t
+        expensive_right = np.argmax(expensive, axis=1) == t
+        confidence = cheap.max(axis=1)
+        self.threshold = 1.0
+        for threshold in sorted(candidates):
+            sure = confidence >= threshold
+            accuracy = np.where(sure, cheap_right, expensive_right).mean()
+            if accuracy >= expensive_right.mean() - max_drop:
+                self.threshold = threshold
+                break
+        return self.threshold
@@ -77,14 +77,23 @@ from scipy import stats
 from scipy import sparse
 import extractors
 from extractors import ffs
+import transforms
+import selection
+import sampling
 from numpy import matlib, exp
 import matplotlib.pyplot as plt
 import sklearn.linear_model
 import pickle
 import util
+import evaluation
+import profiling
+import scheduling
+import fastparse
+import drift
 import sys
 
-def extract_feats(ffs, direc="train", global_feat_dict=None, silent=True):
+def extract_feats(ffs, direc="train", global_feat_dict=None, silent=True, files=None,
+                  parser="etree", monitor=None):
     """
     arguments:
       ffs are a list of feature-functions.
@@ -92,6 +101,17 @@ def extract_feats(ffs, direc="train", global_feat_dict=None, silent=True):
       global_feat_dict is a dictionary mapping feature_names to column-numbers; it
       should only be provided when extracting features from test data, so that 
       the columns of the test matrix align correctly.
+      files is an optional list of the file names in direc to extract (say, one
+      shard of a manifest); by default every file in direc is extracted. Rows
+      come out in sorted file name order either way, so they are the same on
+      every machine and every run.
+      parser is "etree" to run ffs on ET.parse of each file, or "expat" or
+      "lxml" to stream each file through fastparse.py instead, which gives
+      the same features without holding the whole tree in memory (only if
+      every ff can be streamed, otherwise ET.parse is used anyway).
+      monitor is an optional drift.DriftMonitor to record the features of each
+      row against global_feat_dict, including those that get dropped (by
+      default, that of the running drift watch, if any).
 
     returns: 
       a sparse design matrix, a dict mapping features to column-numbers,
@@ -105,8 +125,10 @@ def extract_feats(ffs, direc="train", global_feat_dict=None, silent=True):
     fds = [] # list of feature dicts
     classes = []
     ids = [] 
-    directory = os.listdir(direc)
+    with profiling.stage("list"):
+        directory = sorted(os.listdir(direc) if files is None else files)
     file_count = len(directory)
+    stream = parser != "etree" and fastparse.streamable(ffs)
     for index, datafile in enumerate(directory):
         if not silent and index % 100 == 0:
             print "   Extracted %d of %d" % (index, file_count)
@@ -123,24 +145,36 @@ def extract_feats(ffs, direc="train", global_feat_dict=None, silent=True):
             assert clazz == "X"
             classes.append(-1)
         rowfd = {}
-        # parse file as an xml document
-        tree = ET.parse(os.path.join(direc,datafile))
-        # accumulate features
-        [rowfd.update(ff(tree)) for ff in ffs]
+        if stream:
+            # parse and extract in one go, without building a tree
+            with profiling.stage("stream"):
+                rowfd = fastparse.stream_feats(ffs, os.path.join(direc,datafile), parser)
+        else:
+            # parse file as an xml document
+            with profiling.stage("parse"):
+                tree = ET.parse(os.path.join(direc,datafile))
+            # accumulate features
+            with profiling.stage("extract"):
+                extractors.index_for(tree, ffs)
+                [rowfd.update(ff(tree)) for ff in ffs]
         #print rowfd
         fds.append(rowfd)
         
-    X,feat_dict = make_design_mat(fds,global_feat_dict)
+    with profiling.stage("design_matrix"):
+        X,feat_dict = make_design_mat(fds,global_feat_dict,monitor)
     return X, feat_dict, np.array(classes), ids
 
 
-def make_design_mat(fds, global_feat_dict=None):
+def make_design_mat(fds, global_feat_dict=None, monitor=None):
     """
     arguments:
       fds is a list of feature dicts (one for each row).
       global_feat_dict is a dictionary mapping feature_names to column-numbers; it
       should only be provided when extracting features from test data, so that 
       the columns of the test matrix align correctly.
+      monitor is an optional drift.DriftMonitor that is given every row,
+      features missing from global_feat_dict included; by default the running
+      drift watch's monitor for global_feat_dict, if any (see drift.py).
        
     returns: 
         a sparse NxD design matrix, where N == len(fds) and D is the number of
@@ -152,6 +186,8 @@ def make_design_mat(fds, global_feat_dict=None):
         feat_dict = dict([(feat, i) for i, feat in enumerate(sorted(all_feats))])
     else:
         feat_dict = global_feat_dict
+        if monitor is None:
+            monitor = drift.monitor_for(global_feat_dict)
         
     cols = []
     rows = []
@@ -159,6 +195,7 @@ def make_design_mat(fds, global_feat_dict=None):
     for i in xrange(len(fds)):
         temp_cols = []
         temp_data = []
+        num_oov = 0
         for feat,val in fds[i].iteritems():
             try:
                 # update temp_cols iff update temp_data
@@ -166,9 +203,14 @@ def make_design_mat(fds, global_feat_dict=None):
                 temp_data.append(val)
             except KeyError as ex:
                 if global_feat_dict is not None:
-                    pass  # new feature in test data; nbd
+                    # new feature in test data; nbd, but keep track of it
+                    if monitor is not None:
+                        monitor.add_oov(feat, val)
+                        num_oov += 1
                 else:
                     raise ex
+        if monitor is not None:
+            monitor.add_row(temp_cols, temp_data, num_oov)
 
         # all fd's features in the same row
         k = len(temp_cols)
@@ -245,15 +287,17 @@ def logistic(features, targets, weights, max_iter = 1000):
 
     pass
 
-def sk_logistic(features, targets, regularization = 0.001):
+def sk_logistic(features, targets, regularization = 0.001, class_weight = None,
+                sample_weight = None):
     """
     Use Scikit Learn 'cause I'm lazy
     First return value is a function that returns a class number based on the input vector
     Second is the actual model objet
+    class_weight and sample_weight are passed on to sklearn (see sampling.py)
     """
 
-    logreg = sklearn.linear_model.LogisticRegression(C=regularization)
-    logreg.fit(features, targets)
+    logreg = sklearn.linear_model.LogisticRegression(C=regularization, class_weight=class_weight)
+    logreg.fit(features, targets, sample_weight=sample_weight)
 
     def predictor(feat):
         return logreg.predict(feat)[0]
@@ -308,27 +352,47 @@ def gen_classifier(X, distribs):
         preds.append(np.argmax(probs))
     return preds
 
+def save_train_features(X_train, global_feat_dict, t_train, train_ids, direc="."):
+    """
+    Pickles the raw training matrix, vocabulary, targets and ids into direc,
+    where main(load=True) picks them up. Nothing is selected yet, so what is
+    saved here, by manifest.py's merges and by incremental.py all share one
+    vocabulary (see select_features).
+    """
+    for name, value in (("X_train", X_train), ("global_feat_dict", global_feat_dict),
+                        ("t_train", t_train), ("train_ids", train_ids)):
+        with open(os.path.join(direc, name), "w") as out:
+            pickle.dump(value, out)
+
+def select_features(X_train, t_train, k=10000):
+    """
+    Picks the k training columns that say the most about the class and fits
+    the feature transform on them. This is the one place selection happens,
+    after the raw features are extracted or loaded.
+    returns the fitted selection.FeatureSelector and transform; a raw matrix
+    X goes to feature_transform.transform(selector.transform(X)).
+    """
+    selector = selection.FeatureSelector(k = k).fit(X_train, t_train)
+    feature_transform = transforms.FeatureTransform().fit(selector.transform(X_train))
+    return selector, feature_transform
+
 ## The following function does the feature extraction, learning, and prediction
-def main(load = False, test=False):
+def main(load = False, test=False, parallel=False, parser="etree", balanced=False,
+         drift_mode=False):
     train_dir = "train"
     test_dir = "test"
     outputfile = "mypredictions.csv"  # feel free to change this or take it as an argument
+    # spread extraction over every cpu, biggest traces first (see scheduling.py)
+    extract = scheduling.extract_feats_parallel if parallel else extract_feats
     
     if not load:
         # extract features
         print "extracting training features..."
-        X_train,global_feat_dict,t_train,train_ids = extract_feats(ffs, train_dir)
+        X_train,global_feat_dict,t_train,train_ids = extract(ffs, train_dir, parser=parser)
         print "done extracting training features"
         print
         print "Saving features"
-        with open("X_train", "w") as out:
-            pickle.dump(X_train, out)
-        with open("global_feat_dict", "w") as out:
-            pickle.dump(global_feat_dict, out)
-        with open("t_train", "w") as out:
-            pickle.dump(t_train, out)
-        with open("train_ids", "w") as out:
-            pickle.dump(train_ids, out)
+        save_train_features(X_train, global_feat_dict, t_train, train_ids)
         print "Done saving"
         print
     else:
@@ -342,10 +406,28 @@ def main(load = False, test=False):
         with open("train_ids", "r")         as out: train_ids =         pickle.load(out)
         print "Done loading"
         print
+
+    # keep only the columns that say the most about the class
+    selector, feature_transform = select_features(X_train, t_train)
+
+    # with "drift", record what the vocabulary misses in the test traces and
+    # how their columns differ from the raw training matrix. Both are from
+    # before selection, so features the selector dropped don't count as new.
+    if drift_mode:
+        drift.start(global_feat_dict, X_train)
+
+    # log-scale, tf-idf weight and normalize the raw counts
+    X_train = feature_transform.transform(selector.transform(X_train))
     
     # TODO train here, and learn your classification parameters
     print "learning..."
-    predictor, _ = sk_logistic(X_train, t_train)
+    with profiling.stage("fit"):
+        if balanced:
+            # train on fewer None rows, with every class weighing the same
+            rows, weights = sampling.balance(t_train)
+            _, logreg = sk_logistic(X_train[rows], t_train[rows], sample_weight=weights)
+        else:
+            _, logreg = sk_logistic(X_train, t_train)
     # distribs = train_generative(X_train, t_train, len(global_feat_dict))
     # Start with logistic regression
     print "done learning"
@@ -356,38 +438,48 @@ def main(load = False, test=False):
     # del t_train
     # del train_ids
     print "extracting test features..."
-    X_test,_,t_ignore,test_ids = extract_feats(ffs, test_dir, global_feat_dict=global_feat_dict)
+    # against the raw vocabulary (for drift), then down to the selected columns
+    X_test,_,t_ignore,test_ids = extract(ffs, test_dir, global_feat_dict=global_feat_dict, parser=parser)
+    X_test = feature_transform.transform(selector.transform(X_test))
     print "done extracting test features"
+    if drift_mode:
+        drift.stop("drift")
     print
     
     # TODO make predictions on text data and write them out
-    error = 0
-    total = X_train.shape[0]
     print "making predictions..."
     # preds = np.argmax(X_test.dot(learned_W),axis=1)
     # preds = gen_classifier(X_train, distribs)
-    # for t_id, p, t in zip(train_ids, preds, t_train):
-    #     if (p != t):
-    #         print "%s: expected %d but got %d" % (t_id, t, p)
-    #         error += 1
     if test:
-        preds = []
-        for x in X_test:
-            preds.append(predictor(x))
+        with profiling.stage("predict"):
+            preds = logreg.predict(X_test)
     else:
-        for index, feats in enumerate(X_train):
-            prediction = predictor(feats)
-            if (prediction != t_train[index]):
-                print "%s: expected %d but got %d" % (train_ids[index], t_train[index], prediction)
-                error += 1
-        print "Correct: %d, Incorrect: %d, Total: %d, Accuracy: %f" % (total - error, error, total, (total - error) / (1.0 * total))
+        # no labels for the test data, so report how well we fit the training data
+        with profiling.stage("predict"):
+            train_preds, seconds = evaluation.timed_predict(logreg, X_train)
+        report = evaluation.evaluate(t_train, train_preds, train_ids, seconds)
+        evaluation.write_report(report, "evaluation")
+        evaluation.print_summary(report)
     print "done making predictions"
     print
-    
-    print "writing predictions..."
-    util.write_predictions(preds, test_ids, outputfile)
-    print "done!"
+
+    if test:
+        print "writing predictions..."
+        with profiling.stage("write"):
+            util.write_predictions(preds, test_ids, outputfile)
+        print "done!"
 
 if __name__ == "__main__":
-    main("load" in sys.argv, "test" in sys.argv)
+    # "profile" records time and peak memory of each stage to memory_profile.json,
+    # "cprofile" and "sample" also profile cpu time (see profiling.py)
+    cpu = "cprofile" if "cprofile" in sys.argv else "sample" if "sample" in sys.argv else None
+    profile = "profile" in sys.argv or cpu is not None
+    if profile:
+        profiling.start(cpu = cpu)
+    # "expat" or "lxml" stream the traces instead of building trees (see fastparse.py)
+    parser = "expat" if "expat" in sys.argv else "lxml" if "lxml" in sys.argv else "etree"
+    main("load" in sys.argv, "test" in sys.argv, "parallel" in sys.argv, parser,
+         "balanced" in sys.argv, "drift" in sys.argv)
+    if profile:
+        profiling.stop("memory_profile.json", cpu_path = "cpu_profile")
     
\ No newline at end of file
@@ -1,20 +1,58 @@
 import os
 import sys
+import time
 import numpy as np
-import random
 import pickle
-from datetime import datetime
 from scipy import stats
 from scipy import sparse
 from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
 import util
-from classifier import extract_feats, sk_logistic
+from classifier import extract_feats
+import calibration
+import cascade
+import dedupe
+import drift
+import ensemble
+import evaluation
+import lazy
+import profiling
+import sampling
+import shared
 import extractors
 from extractors import ffs
-from randomforest_classifier import sk_random_forest
+
+# model configurations trained side by side by "compare"
+COMPARE_CONFIGS = [
+    ("forest", RandomForestClassifier(n_estimators = 100)),
+    ("forest_balanced", RandomForestClassifier(n_estimators = 100,
+                                               class_weight = "balanced_subsample")),
+    ("logistic", LogisticRegression(C = 0.001)),
+    ("logistic_c1", LogisticRegression(C = 1.0)),
+]
+
+def compare_models(X_train, t_train, X_holdout, t_holdout, holdout_ids):
+    """
+    Trains every configuration in COMPARE_CONFIGS at once in worker processes
+    that share X_train (one CSC float32 copy for the forests, one CSR for the
+    logistic regressions, see shared.train_models), and reports each on the
+    holdout
+    """
+    names = [name for name, _ in COMPARE_CONFIGS]
+    with profiling.stage("fit"):
+        fitted = shared.train_models([model for _, model in COMPARE_CONFIGS],
+                                     X_train, t_train)
+    for name, model in zip(names, fitted):
+        preds, seconds = evaluation.timed_predict(model, X_holdout)
+        report = evaluation.evaluate(t_holdout, preds, holdout_ids, seconds)
+        evaluation.write_report(report, "evaluation-" + name)
+        print name
+        evaluation.print_summary(report)
+        print
 
 ## The following function does the feature extraction, learning, and prediction
-def main(load = False, test=False, both=False):
+def main(load = False, test=False, both=False, balanced=False, calibrate=False,
+         cascade_mode=False, lazy_mode=False, compare=False, drift_mode=False):
     train_dir = "train"
     test_dir = "test"
     outputfile = "treepredictions.csv"  # feel free to change this or take it as an argument
@@ -59,17 +97,62 @@ def main(load = False, test=False, both=False):
         t_holdout = ts[:-int(n*train_pct)]
         holdout_ids = ids[:-int(n*train_pct)]
         print
+    if compare and not test:
+        print "comparing models..."
+        compare_models(X_train, t_train, X_holdout, t_holdout, holdout_ids)
+        return
+
     # TODO train here, and learn your classification parameters
     print "learning..."
     num_trees = 100
-    forest = RandomForestClassifier(n_estimators = num_trees)
-    forest = forest.fit(X_train.todense(), t_train)
-    # Random forest predictor
-    forest_predictor, _ = sk_random_forest(X_train.toarray(), t_train, num_trees = num_trees)
-    # logistic regression predictor
-    # log_predictor, _ = sk_logistic(X_train, t_train)
+    # forest and logistic regression, trained side by side and combined by
+    # a meta-learner fitted on their out-of-fold probabilities. Near-duplicate
+    # training traces are dropped first, and test traces with a near-exact
+    # training match just take its label.
+    # with "balanced", most None rows are left out and the models weigh every
+    # class the same (the forest within each tree's bootstrap sample)
+    class_weight = "balanced" if balanced else None
+    model = dedupe.NearDuplicateClassifier(ensemble.EnsembleClassifier([
+        RandomForestClassifier(n_estimators = num_trees,
+                               class_weight = "balanced_subsample" if balanced else None),
+        LogisticRegression(C = 0.001, class_weight = class_weight),
+    ], combine = "stack"))
+    if calibrate:
+        # fit on most of the training data, calibrate on the rest
+        model = calibration.CalibratedModel(model, method = "temperature")
+    if cascade_mode:
+        # a calibrated logistic regression on the plain syscall counts answers
+        # the traces it is sure about, the rest go on to the model above
+        model = cascade.CascadeClassifier(model, cascade.unigram_columns(global_feat_dict))
+    if balanced:
+        rows = sampling.subsample_majority(t_train)
+        X_train, t_train = X_train[rows], t_train[rows]
+        train_ids = [train_ids[i] for i in rows]
+    with profiling.stage("fit"):
+        if cascade_mode:
+            # hold some of each class out to pick the lowest threshold that
+            # costs no accuracy against the full model
+            fit_rows, tune_rows = calibration.stratified_holdout(t_train, 0.2)
+            model.fit(X_train[fit_rows], t_train[fit_rows])
+            X_tune, t_tune = X_train[tune_rows], t_train[tune_rows]
+            threshold = model.tune_threshold(X_tune, t_tune)
+            tune_accuracy = np.mean(model.predict(X_tune) == t_tune)
+            print "Cascade threshold %.2f: cheap model answers %.1f%% of the tuning rows, accuracy %.3f" % (
+                threshold, 100 * model.exit_rate_, tune_accuracy)
+        else:
+            model.fit(X_train, t_train)
+        if lazy_mode:
+            # a cheap model on the syscall counts of the first MB of each
+            # trace; only traces it isn't sure of get fully extracted
+            files_by_id = dict((f.split('.')[0], f) for f in os.listdir(train_dir))
+            model = lazy.LazyCascade(model, global_feat_dict, ffs)
+            model.fit(train_dir, [files_by_id[i] for i in train_ids])
     print "done learning"
     print
+    # with "drift", record what the vocabulary misses in whatever is extracted
+    # to predict from here on, and how its columns differ from training
+    if drift_mode:
+        drift.start(global_feat_dict, X_train)
     
     # get rid of training data and load test data
     # del X_train
@@ -78,7 +161,15 @@ def main(load = False, test=False, both=False):
     
     
     # if you want to write predictions for test data
-    if test:
+    if test and lazy_mode:
+        print "making and writing predictions..."
+        with profiling.stage("predict"):
+            preds, test_ids = model.predict(test_dir)
+        with profiling.stage("write"):
+            util.write_predictions(preds, test_ids, outputfile)
+        print "Cheap model answered %.1f%% of the test traces" % (100 * model.exit_rate_)
+        print "done!"
+    elif test:
         # if you didn't save both sets of features, extract
         if not both:
             print "extracting test features..."
@@ -98,46 +189,42 @@ def main(load = False, test=False, both=False):
             with open("test_ids", "r")         as out: test_ids =         pickle.load(out)
             print "Done loading"
             print
-        # TODO make predictions here
-        print "making predictions..."
-        preds = forest.predict(X_test.toarray())
-        print "done making predictions"
-
-        print "writing predictions..."
-        util.write_predictions(preds, test_ids, outputfile)
+        # score the test matrix a chunk at a time, writing as we go (profiled
+        # as separate predict and write stages)
+        print "making and writing predictions..."
+        util.stream_predictions(model, X_test, test_ids, outputfile)
         print "done!"
     else:
-        error = 0
-        total = X_holdout.shape[0]
         print "making predictions..."
-        #preds = np.argmax(X_test.dot(learned_W),axis=1)
-        #preds = logreg.predict(X_test)
-        random.seed(datetime.now())
-        for index, feats in enumerate(X_holdout.toarray()):
-            pred_forest = forest_predictor(feats)
-            # pred_logistic = log_predictor(feats)
-            # #if they agree, or disagree and both predict malware
-            # if pred_forest == pred_logistic or (pred_forest != 8 and pred_logistic != 8):
-            #     prediction = pred_forest
-            # else:
-            #     # grab the non-"None" label
-            #     other = pred_forest if pred_forest != 8 else pred_logistic
-            #     # flip a coin
-            #     if random.random() < 0.39:
-            #         prediction = 8
-            #     else:
-            #         prediction = other
-            prediction = pred_forest
-
-            if (prediction != t_holdout[index]):
-                print "%s: expected %d but got %d" % (holdout_ids[index], t_holdout[index], prediction)
-                error += 1
-        print "Correct: %d, Incorrect: %d, Total: %d, Accuracy: %f" % (total - error, error, total, (total - error) / (1.0 * total))
+        with profiling.stage("predict"):
+            if lazy_mode:
+                start = time.time()
+                preds, _ = model.predict(train_dir, [files_by_id[i] for i in holdout_ids])
+                seconds = time.time() - start
+            else:
+                preds, seconds = evaluation.timed_predict(model, X_holdout)
+        report = evaluation.evaluate(t_holdout, preds, holdout_ids, seconds)
+        evaluation.write_report(report, "evaluation")
+        evaluation.print_summary(report)
+        if cascade_mode or lazy_mode:
+            print "Cheap model answered %.1f%% of the holdout" % (100 * model.exit_rate_)
         print "done making predictions"
         print
+    if drift_mode:
+        drift.stop("drift")
     print
 
 
 
 if __name__ == "__main__":
-    main("load" in sys.argv, "test" in sys.argv, "both" in sys.argv)
\ No newline at end of file
+    # "profile" records time and peak memory of each stage to memory_profile.json,
+    # "cprofile" and "sample" also profile cpu time (see profiling.py)
+    cpu = "cprofile" if "cprofile" in sys.argv else "sample" if "sample" in sys.argv else None
+    profile = "profile" in sys.argv or cpu is not None
+    if profile:
+        profiling.start(cpu = cpu)
+    main("load" in sys.argv, "test" in sys.argv, "both" in sys.argv, "balanced" in sys.argv,
+         "calibrate" in sys.argv, "cascade" in sys.argv, "lazy" in sys.argv,
+         "compare" in sys.argv, "drift" in sys.argv)
+    if profile:
+        profiling.stop("memory_profile.json", cpu_path = "cpu_profile")
\ No newline at end of file
@@ -0,0 +1,191 @@
+## Near-duplicate traces
+## ---------------------
+## Malware families churn out lots of nearly identical traces. We summarize
+## each row of the design matrix by a MinHash signature of its set of nonzero
+## features (the syscalls, dlls, registry keys, ... it touched), so that the
+## fraction of equal signature entries between two rows estimates the Jaccard
+## similarity of their feature sets. An LSH index over bands of the signatures
+## then finds the likely near-duplicates of a row without comparing it to
+## every other row.
+##
+## That lets us drop redundant training rows before fitting, and answer a test
+## row straight from the label of a near-exact training match when there is
+## one, leaving the real model for everything else.
+
+import numpy as np
+from scipy import sparse
+import util
+
+# a mersenne prime; with a, b and the column ids all below it, a * x + b fits
+# comfortably in an int64
+PRIME = (1 << 31) - 1
+
+class LSHIndex(object):
+    """
+    arguments:
+      num_perm is the length of the MinHash signatures
+      bands is the number of LSH bands they are split into. Two rows with
+        Jaccard similarity s end up sharing a bucket with probability
+        1 - (1 - s^r)^bands, where r = num_perm / bands.
+    """
+    def __init__(self, num_perm=128, bands=32, seed=0):
+        assert num_perm % bands == 0
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, PRIME, size=num_perm).astype(np.int64)
+        self.b = rng.randint(0, PRIME, size=num_perm).astype(np.int64)
+        self.buckets = {}   # (band, band signature) -> list of items
+        self.sigs = []
+        self.labels = []
+
+    def signatures(self, X):
+        """
+        returns the N x num_perm MinHash signatures of the rows of the sparse
+        matrix X, each taken over the set of that row's nonzero columns. One
+        vectorized pass over the nonzeros per hash function; empty rows get
+        all-PRIME signatures.
+        """
+        X = sparse.csr_matrix(X)
+        X.eliminate_zeros()
+        cols = X.indices.astype(np.int64)
+        nonempty = np.diff(X.indptr) > 0
+        starts = X.indptr[:-1][nonempty]
+        sigs = np.empty((X.shape[0], self.num_perm), dtype=np.int64)
+        sigs.fill(PRIME)
+        if len(cols) == 0:
+            return sigs
+        for k in xrange(self.num_perm):
+            hashes = (self.a[k] * cols + self.b[k]) % PRIME
+            sigs[nonempty, k] = np.minimum.reduceat(hashes, starts)
+        return sigs
+
+    def _band_keys(self, sig):
+        r = self.rows_per_band
+        return [(band, sig[band * r:(band + 1) * r].tostring())
+                for band in xrange(self.bands)]
+
+    def add(self, sigs, labels):
+        """
+        Adds rows with the given signatures and labels to the index
+        """
+        for sig, label in zip(sigs, labels):
+            item = len(self.sigs)
+            self.sigs.append(sig)
+            self.labels.append(label)
+            for key in self._band_keys(sig):
+                self.buckets.setdefault(key, []).append(item)
+
+    def candidates(self, sig):
+        """
+        Items sharing at least one band with sig
+        """
+        found = set()
+        for key in self._band_keys(sig):
+            found.update(self.buckets.get(key, ()))
+        return found
+
+    def nearest(self, sig, threshold=0.9):
+        """
+        returns (item, estimated jaccard similarity) of the most similar
+        indexed item to sig, or None if no candidate reaches threshold
+        """
+        best, best_sim = None, threshold
+        for item in self.candidates(sig):
+            sim = np.mean(self.sigs[item] == sig)
+            if sim >= best_sim:
+                best, best_sim = item, sim
+        if best is None:
+            return None
+        return best, best_sim
+
+def dedupe_rows(X, t, threshold=0.9, index=None, sigs=None):
+    """
+    Picks one representative from every group of rows of X that are
+    near-duplicates (estimated Jaccard similarity >= threshold) with the same
+    class in t. Near-duplicates with different classes are all kept.
+    sigs are the rows' signatures from index, if already computed.
+    returns:
+      the sorted row numbers to keep, and for each kept row the number of
+      rows it stands for (usable as sample weights)
+    """
+    index = index if index is not None else LSHIndex()
+    if sigs is None:
+        sigs = index.signatures(X)
+    base = len(index.sigs)  # items already in the index aren't ours to count
+    keep = []
+    counts = []
+    for row, (sig, label) in enumerate(zip(sigs, t)):
+        match = index.nearest(sig, threshold)
+        if match is not None and index.labels[match[0]] == label:
+            if match[0] >= base:
+                counts[match[0] - base] += 1
+            continue
+        index.add([sig], [label])
+        keep.append(row)
+        counts.append(1)
+    return np.array(keep, dtype=int), np.array(counts)
+
+class NearDuplicateClassifier(object):
+    """
+    Wraps a classifier (anything with fit/predict_proba). fit() drops
+    near-duplicate training rows before fitting model, weighing each row it
+    keeps by the number of rows it stands for (so classes with lots of
+    duplicates keep their share) unless weight_duplicates is False, and
+    indexes every training row. Rows given to predict/predict_proba that
+    have a match in the index at or above threshold get that row's label
+    outright; only the rest are passed on to model.
+    """
+    def __init__(self, model, threshold=0.95, dedupe_threshold=0.9,
+                 num_perm=128, bands=32, seed=0, weight_duplicates=True):
+        self.model = model
+        self.weight_duplicates = weight_duplicates
+        self.threshold = threshold
+        self.dedupe_threshold = dedupe_threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.seed = seed
+
+    def fit(self, X, t):
+        t = np.asarray(t)
+        self.index_ = LSHIndex(self.num_perm, self.bands, self.seed)
+        sigs = self.index_.signatures(X)
+        # dedupe with the same hash functions, then shortcut to any training
+        # row, not just the representatives the model is fitted on
+        keep, counts = dedupe_rows(X, t, self.dedupe_threshold,
+                                   LSHIndex(self.num_perm, self.bands, self.seed), sigs)
+        self.index_.add(sigs, t)
+        if self.weight_duplicates:
+            self.model.fit(X[keep], t[keep], sample_weight=counts)
+        else:
+            self.model.fit(X[keep], t[keep])
+        return self
+
+    def matches(self, X):
+        """
+        returns the label of each row's near-exact match, or -1 where there
+        isn't one
+        """
+        labels = np.empty(X.shape[0], dtype=int)
+        labels.fill(-1)
+        for row, sig in enumerate(self.index_.signatures(X)):
+            match = self.index_.nearest(sig, self.threshold)
+            if match is not None:
+                labels[row] = self.index_.labels[match[0]]
+        return labels
+
+    def predict_proba(self, X):
+        X = sparse.csr_matrix(X)
+        labels = self.matches(X)
+        matched = labels >= 0
+        probas = np.zeros((X.shape[0], len(util.malware_classes)))
+        probas[matched, labels[matched]] = 1.0
+        if not matched.all():
+            rest = np.flatnonzero(~matched)
+            probas[rest] = util.full_probas(self.model,
+                                            self.model.predict_proba(X[rest]))
+        return probas
+
+    def predict(self, X):
+        return np.argmax(self.predict_proba(X), axis=1)
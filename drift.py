@@ -0,0 +1,299 @@
+## Drift monitoring
+## ----------------
+## make_design_mat drops every test feature that isn't in the training
+## vocabulary, so as malware changes we lose signal without noticing.
+## DriftMonitor watches test extraction instead: make_design_mat hands it every
+## row, and it keeps
+##
+##   - for the out-of-vocabulary (OOV) features, a count-min sketch of how many
+##     rows each one turned up in, a HyperLogLog estimate of how many distinct
+##     ones there are, the heaviest few of them, and how many there were (and
+##     their total value) per feature family (the prefix before the first "-",
+##     roughly which extractor made it)
+##   - for the vocabulary's columns, how many rows each is nonzero in and the
+##     sum and sum of squares of its values, to compare with the training matrix
+##
+## The sketches take a fixed amount of memory however many new features
+## show up; the column statistics are a few arrays the width of the vocabulary.
+##
+## Like profiling, a watch can run for the whole program rather than a monitor
+## being handed to one call: while one is running, every make_design_mat that
+## maps rows onto a vocabulary records them (serial, parallel, partial and
+## lazy extraction all go through it), with one monitor per vocabulary. Only
+## the vocabulary given to start is compared against the training matrix.
+##
+##   drift.start(global_feat_dict, X_train)
+##   ... extract and predict however ...
+##   drift.stop("drift")   # writes drift.json and prints a summary
+##
+## or, for one extraction,
+##
+##   monitor = drift.DriftMonitor(global_feat_dict, X_train)
+##   X_test, ... = extract_feats(ffs, "test", global_feat_dict, monitor=monitor)
+##   drift.write_report(monitor.report(), "drift")
+
+import hashlib
+import json
+import math
+import struct
+import numpy as np
+
+MASK64 = (1 << 64) - 1
+
+# the running watch, if any
+current = None
+
+def hash_pair(key):
+    """
+    Two independent 64 bit hashes of the string key
+    """
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return struct.unpack("<QQ", hashlib.md5(key).digest())
+
+def family(feat):
+    return feat.split("-", 1)[0] if "-" in feat else "(plain)"
+
+class CountMinSketch(object):
+    """
+    Estimates how often each key was added, never under-counting; with
+    probability 1 - exp(-depth) a key's estimate is over by at most
+    e / width of the total count.
+    """
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+
+    def _columns(self, hashes):
+        h1, h2 = hashes
+        # double hashing: depth hash functions out of two
+        return [((h1 + i * h2) & MASK64) % self.width for i in xrange(self.depth)]
+
+    def add(self, key, count=1, hashes=None):
+        columns = self._columns(hashes or hash_pair(key))
+        self.table[np.arange(self.depth), columns] += count
+        self.total += count
+
+    def estimate(self, key, hashes=None):
+        columns = self._columns(hashes or hash_pair(key))
+        return int(self.table[np.arange(self.depth), columns].min())
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct keys added, within about
+    1.04 / sqrt(2^precision) relative error
+    """
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    def add(self, key, hashes=None):
+        h = (hashes or hash_pair(key))[0]
+        index = h >> (64 - self.precision)
+        rest = (h << self.precision) & MASK64
+        # position of the first 1 bit of the remaining bits
+        rank = 64 - self.precision + 1 if rest == 0 else 64 - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self):
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.power(2.0, -self.registers.astype(float)).sum()
+        empty = int((self.registers == 0).sum())
+        if raw <= 2.5 * m and empty:
+            # small range correction: linear counting
+            return m * math.log(m / empty)
+        return raw
+
+class DriftMonitor(object):
+    """
+    arguments:
+      feat_dict is the training vocabulary (feature name -> column)
+      reference is the training design matrix, the column statistics of the
+        test rows are compared against
+      width, depth size the count-min sketch and precision the HyperLogLog
+      top_k is how many of the most frequent OOV features are kept by name
+    """
+    def __init__(self, feat_dict, reference=None, width=4096, depth=4,
+                 precision=12, top_k=20):
+        self.feat_dict = feat_dict
+        self.names = [None] * len(feat_dict)
+        for feat, col in feat_dict.iteritems():
+            self.names[col] = feat
+        self.oov_rows = CountMinSketch(width, depth)
+        self.oov_distinct = HyperLogLog(precision)
+        self.top_k = top_k
+        self.heavy = {}
+        self.families = {}
+        self.rows = 0
+        self.rows_with_oov = 0
+        self.known_values = 0.0
+        self.oov_values = 0.0
+        self.nonzero = np.zeros(len(feat_dict), dtype=np.int64)
+        self.sums = np.zeros(len(feat_dict))
+        self.squares = np.zeros(len(feat_dict))
+        self.reference = None if reference is None else column_stats(reference)
+
+    def add_oov(self, feat, val):
+        """
+        Records an OOV feature of the current row (each at most once per row)
+        """
+        hashes = hash_pair(feat)
+        self.oov_rows.add(feat, hashes=hashes)
+        self.oov_distinct.add(feat, hashes=hashes)
+        self.oov_values += abs(val)
+        count, values = self.families.get(family(feat), (0, 0.0))
+        self.families[family(feat)] = (count + 1, values + abs(val))
+        # the heaviest keys seen so far, by their sketch estimates
+        count = self.oov_rows.estimate(feat, hashes=hashes)
+        if feat in self.heavy or len(self.heavy) < self.top_k:
+            self.heavy[feat] = count
+        else:
+            lightest = min(self.heavy, key=self.heavy.get)
+            if count > self.heavy[lightest]:
+                del self.heavy[lightest]
+                self.heavy[feat] = count
+
+    def add_row(self, cols, data, num_oov):
+        """
+        Records a row's in-vocabulary columns and values, after its OOV
+        features went to add_oov
+        """
+        cols = np.asarray(cols, dtype=int)
+        data = np.asarray(data, dtype=float)
+        self.rows += 1
+        self.rows_with_oov += num_oov > 0
+        self.known_values += np.abs(data).sum()
+        nonzero = data != 0
+        self.nonzero[cols[nonzero]] += 1
+        np.add.at(self.sums, cols, data)
+        np.add.at(self.squares, cols, data * data)
+
+    def report(self, num_columns=20):
+        """
+        returns a dict summarizing the OOV features and the num_columns
+        columns whose share of nonzero rows moved furthest from training
+        """
+        rows = float(max(1, self.rows))
+        values = self.known_values + self.oov_values
+        report = {
+            "rows": self.rows,
+            "rows_with_oov": self.rows_with_oov,
+            "oov_row_fraction": self.rows_with_oov / rows,
+            "oov_value_fraction": self.oov_values / values if values else 0.0,
+            "oov_distinct_estimate": int(round(self.oov_distinct.estimate())),
+            "oov_top": [{"feature": feat, "rows": self.oov_rows.estimate(feat)}
+                        for feat in sorted(self.heavy, key=self.heavy.get, reverse=True)],
+            "oov_families": [{"family": name, "features": count, "values": total}
+                             for name, (count, total) in sorted(self.families.items())],
+            "vocabulary": len(self.feat_dict),
+            "columns_seen": int((self.nonzero > 0).sum()),
+        }
+        mean = self.sums / rows
+        std = np.sqrt(np.maximum(self.squares / rows - mean * mean, 0))
+        rate = self.nonzero / rows
+        if self.reference is not None:
+            shift = rate - self.reference["rate"]
+            # standardized by the training spread, so counts and flags compare
+            scale = np.maximum(self.reference["std"], 1e-9)
+            mean_shift = (mean - self.reference["mean"]) / scale
+            report["columns_vanished"] = int(((self.reference["rate"] > 0) & (rate == 0)).sum())
+            report["mean_abs_rate_shift"] = float(np.abs(shift).mean()) if len(shift) else 0.0
+            order = np.argsort(-np.abs(shift), kind="mergesort")[:num_columns]
+            report["columns_drifted"] = [
+                {"feature": self.names[col],
+                 "train_rate": float(self.reference["rate"][col]), "test_rate": float(rate[col]),
+                 "train_mean": float(self.reference["mean"][col]), "test_mean": float(mean[col]),
+                 "mean_shift": float(mean_shift[col])}
+                for col in order if shift[col] != 0]
+        else:
+            order = np.argsort(-rate, kind="mergesort")[:num_columns]
+            report["columns_densest"] = [
+                {"feature": self.names[col], "rate": float(rate[col]),
+                 "mean": float(mean[col]), "std": float(std[col])} for col in order]
+        return report
+
+def column_stats(X):
+    """
+    The share of rows each column of the sparse matrix X is nonzero in, and
+    its mean and standard deviation
+    """
+    X = X.tocsc()
+    rows = float(max(1, X.shape[0]))
+    rate = np.diff(X.indptr) / rows
+    mean = np.asarray(X.sum(axis=0)).ravel() / rows
+    squares = np.asarray(X.multiply(X).sum(axis=0)).ravel() / rows
+    return {"rate": rate, "mean": mean, "std": np.sqrt(np.maximum(squares - mean * mean, 0))}
+
+def write_report(report, path="drift"):
+    with open(path + ".json", "w") as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+
+def print_summary(report):
+    print "Drift: %d of %d rows had features missing from the vocabulary (%.1f%% of feature mass)" % (
+        report["rows_with_oov"], report["rows"], 100 * report["oov_value_fraction"])
+    print "       about %d distinct new features; %d of %d columns seen" % (
+        report["oov_distinct_estimate"], report["columns_seen"], report["vocabulary"])
+    if "columns_vanished" in report:
+        print "       %d training columns never nonzero in test, mean shift in nonzero rate %.4f" % (
+            report["columns_vanished"], report["mean_abs_rate_shift"])
+    for row in report["oov_top"][:5]:
+        print "       new: %-40s in ~%d rows" % (row["feature"][:40], row["rows"])
+
+class DriftWatch(object):
+    """
+    The DriftMonitors of one run, one per vocabulary rows were mapped onto.
+    arguments are as for DriftMonitor; feat_dict (if given) is the training
+    vocabulary, the only one compared against reference.
+    """
+    def __init__(self, feat_dict=None, reference=None, **monitor_args):
+        self.feat_dict = feat_dict
+        self.reference = reference
+        self.monitor_args = monitor_args
+        self.monitors = []
+        if feat_dict is not None:
+            self.monitor_for(feat_dict)
+
+    def monitor_for(self, feat_dict):
+        for known, monitor in self.monitors:
+            if known is feat_dict:
+                return monitor
+        if self.monitors and self.feat_dict is not None and feat_dict == self.feat_dict:
+            # a pickled copy of the training vocabulary still counts as it
+            return self.monitors[0][1]
+        training = feat_dict is self.feat_dict
+        monitor = DriftMonitor(feat_dict, self.reference if training else None,
+                               **self.monitor_args)
+        self.monitors.append((feat_dict, monitor))
+        return monitor
+
+def start(feat_dict=None, reference=None, **monitor_args):
+    global current
+    current = DriftWatch(feat_dict, reference, **monitor_args)
+    return current
+
+def monitor_for(feat_dict):
+    """
+    The running watch's monitor for feat_dict, or None if no watch is running
+    """
+    return None if current is None else current.monitor_for(feat_dict)
+
+def stop(path="drift"):
+    """
+    Stops the running watch, writes the report of every vocabulary to
+    path.json and prints their summaries. returns the reports.
+    """
+    global current
+    watch, current = current, None
+    if watch is None:
+        return []
+    reports = [monitor.report() for _, monitor in watch.monitors if monitor.rows]
+    write_report({"vocabularies": reports}, path)
+    if not reports:
+        print "Drift: no rows were mapped onto a training vocabulary"
+    for report in reports:
+        print_summary(report)
+    return reports
@@ -0,0 +1,144 @@
+## Ensembles
+## ---------
+## EnsembleClassifier combines several base models (say a random forest and
+## logistic regression) by their predict_proba outputs. The base models are
+## trained side by side in worker processes, and everything at prediction time
+## is done on the whole matrix at once rather than row by row.
+##
+## combine="average" takes a weighted average of the base models' class
+## probabilities. combine="stack" instead fits a meta-learner on out-of-fold
+## probabilities: each base model is refit on all but one of the folds of the
+## training data and predicts the held-out fold, so the meta-learner learns how
+## far to trust each model on rows it hasn't seen.
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold
+import profiling
+import shared
+import util
+
+def _fit(task):
+    """
+    Fits one model on the given rows of X. Runs in a worker process, so it has
+    to be a module-level function that can be pickled.
+    """
+    model, X, t, train_rows, predict_rows, sample_weight = task
+    if isinstance(X, shared.SharedMatrix):
+        X = X.load()
+    if train_rows is not None:
+        X, t, X_predict = X[train_rows], t[train_rows], X[predict_rows]
+        if sample_weight is not None:
+            sample_weight = sample_weight[train_rows]
+    with profiling.stage("fit"):
+        if sample_weight is None:
+            model.fit(X, t)
+        else:
+            model.fit(X, t, sample_weight=sample_weight)
+    if predict_rows is None:
+        return model
+    with profiling.stage("predict"):
+        return util.full_probas(model, model.predict_proba(X_predict))
+
+def run_tasks(tasks, processes=None):
+    """
+    Runs _fit over tasks, in parallel worker processes unless processes is 1.
+    Every task trains on the same X, which the workers share through memory
+    maps (see shared.py) rather than each getting its own pickled copy.
+    """
+    if processes == 1 or len(tasks) == 1:
+        return map(_fit, tasks)
+    matrix = shared.SharedMatrix.create(tasks[0][1])
+    tasks = [(task[0], matrix) + task[2:] for task in tasks]
+    pool = profiling.make_pool(processes)
+    try:
+        return pool.map(_fit, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        profiling.merge_workers()
+        matrix.remove()
+
+class EnsembleClassifier(object):
+    """
+    arguments:
+      models is a list of unfitted sklearn classifiers with predict_proba
+      weights are the weights of each model when combine="average"
+        (defaults to equal weights)
+      combine is "average" or "stack"
+      meta is the meta-learner fitted on out-of-fold probabilities when
+        combine="stack" (defaults to multinomial logistic regression)
+      folds is the number of folds for the out-of-fold probabilities
+      processes is the number of worker processes (None for one per cpu)
+    """
+    def __init__(self, models, weights=None, combine="average", meta=None,
+                 folds=5, processes=None, random_state=0):
+        if combine not in ("average", "stack"):
+            raise ValueError("Unknown way to combine models: %s" % combine)
+        self.models = models
+        if weights is None:
+            weights = np.ones(len(models))
+        self.weights = np.asarray(weights, dtype=float) / np.sum(weights)
+        self.combine = combine
+        if meta is None:
+            meta = LogisticRegression(solver="lbfgs", multi_class="multinomial",
+                                      max_iter=1000)
+        self.meta = meta
+        self.folds = folds
+        self.processes = processes
+        self.random_state = random_state
+
+    def fit(self, X, t, sample_weight=None):
+        """
+        sample_weight, if given, weighs the rows for the base models and the
+        meta-learner alike
+        """
+        t = np.asarray(t)
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight, dtype=float)
+        tasks = [(clone(model), X, t, None, None, sample_weight) for model in self.models]
+        if self.combine == "stack":
+            oof = self.out_of_fold_probas(X, t, sample_weight)
+            self.meta.fit(oof, t, sample_weight=sample_weight)
+        self.fitted_models_ = run_tasks(tasks, self.processes)
+        return self
+
+    def out_of_fold_probas(self, X, t, sample_weight=None):
+        """
+        returns an N x (num models * num classes) matrix holding, for every
+        row, each base model's class probabilities from the fold where that
+        row was held out. All models x folds fits run in parallel.
+        """
+        # with tiny training sets there may not be enough rows for every fold
+        folds = max(2, min(self.folds, np.bincount(t).max()))
+        skf = StratifiedKFold(n_splits=folds, shuffle=True,
+                              random_state=self.random_state)
+        splits = list(skf.split(np.zeros(len(t)), t))
+        tasks = [(clone(model), X, t, train_rows, predict_rows, sample_weight)
+                 for model in self.models for train_rows, predict_rows in splits]
+        results = run_tasks(tasks, self.processes)
+        C = len(util.malware_classes)
+        oof = np.zeros((len(t), C * len(self.models)))
+        for i, probas in enumerate(results):
+            m, k = divmod(i, len(splits))
+            oof[splits[k][1], m * C:(m + 1) * C] = probas
+        return oof
+
+    def base_probas(self, X):
+        """
+        returns a (num models) x N x (num classes) array of each fitted base
+        model's class probabilities
+        """
+        return np.array([util.full_probas(model, model.predict_proba(X))
+                         for model in self.fitted_models_])
+
+    def predict_proba(self, X):
+        probas = self.base_probas(X)
+        if self.combine == "average":
+            return np.tensordot(self.weights, probas, axes=1)
+        stacked = np.hstack(probas)
+        return util.full_probas(self.meta, self.meta.predict_proba(stacked))
+
+    def predict(self, X):
+        return np.argmax(self.predict_proba(X), axis=1)
@@ -0,0 +1,137 @@
+## Evaluation
+## ----------
+## Scores a whole array of predictions against the true classes at once: the
+## confusion matrix over util.malware_classes comes from a single bincount, and
+## per-class precision/recall/F1, accuracy and macro-F1 are read off it. The
+## report goes to a json file (everything), a csv of the per-class metrics, a
+## csv of the confusion matrix and a csv of the misclassified ids, rather than
+## one console line per miss.
+##
+##   preds, seconds = evaluation.timed_predict(model, X_holdout)
+##   report = evaluation.evaluate(t_holdout, preds, holdout_ids, seconds)
+##   evaluation.write_report(report, "evaluation")
+##   evaluation.print_summary(report)
+
+import csv
+import json
+import time
+import numpy as np
+import util
+
+def confusion_matrix(t, preds, num_classes=None):
+    """
+    returns the num_classes x num_classes matrix whose [i, j] entry is the
+    number of rows of class i predicted as class j
+    """
+    if num_classes is None:
+        num_classes = len(util.malware_classes)
+    t = np.asarray(t, dtype=np.int64)
+    preds = np.asarray(preds, dtype=np.int64)
+    cells = np.bincount(t * num_classes + preds, minlength=num_classes * num_classes)
+    return cells.reshape(num_classes, num_classes)
+
+def _ratio(num, den):
+    # 0/0 (a class never predicted, or never present) counts as 0
+    return np.where(den > 0, num / np.maximum(den, 1).astype(float), 0.0)
+
+def class_metrics(cm):
+    """
+    returns arrays of each class's precision, recall, F1 and support from a
+    confusion matrix
+    """
+    correct = np.diag(cm)
+    support = cm.sum(axis=1)
+    predicted = cm.sum(axis=0)
+    precision = _ratio(correct, predicted)
+    recall = _ratio(correct, support)
+    f1 = _ratio(2 * precision * recall, precision + recall)
+    return precision, recall, f1, support
+
+def timed_predict(model, X):
+    """
+    returns model.predict(X) and how many seconds it took
+    """
+    start = time.time()
+    preds = model.predict(X)
+    return preds, time.time() - start
+
+def evaluate(t, preds, ids=None, predict_seconds=None):
+    """
+    arguments:
+      t is the array of true class indices
+      preds is the array of predicted class indices
+      ids are the ids of the rows, used to list the misclassified rows
+      predict_seconds is how long the predictions took, if known
+    returns:
+      a json-ready dict with the accuracy, macro-F1 (over the classes present
+      in t), per-class metrics, the confusion matrix, the misses and timings
+    """
+    start = time.time()
+    t = np.asarray(t)
+    preds = np.asarray(preds)
+    cm = confusion_matrix(t, preds)
+    precision, recall, f1, support = class_metrics(cm)
+    present = support > 0
+    total = len(t)
+    correct = int(np.trace(cm))
+    missed = np.flatnonzero(t != preds)
+    report = {
+        "total": total,
+        "correct": correct,
+        "accuracy": correct / float(total) if total else 0.0,
+        "macro_f1": float(f1[present].mean()) if present.any() else 0.0,
+        "classes": [{"class": name,
+                     "precision": float(precision[i]),
+                     "recall": float(recall[i]),
+                     "f1": float(f1[i]),
+                     "support": int(support[i])}
+                    for i, name in enumerate(util.malware_classes)],
+        "confusion_matrix": cm.tolist(),
+        "misses": [{"id": ids[i] if ids is not None else int(i),
+                    "expected": int(t[i]),
+                    "predicted": int(preds[i])}
+                   for i in missed],
+        "predict_seconds": predict_seconds,
+    }
+    report["evaluate_seconds"] = time.time() - start
+    if predict_seconds:
+        report["rows_per_second"] = total / predict_seconds
+    return report
+
+def write_report(report, path="evaluation"):
+    """
+    Writes report to path.json, its per-class metrics to path-classes.csv, its
+    confusion matrix to path-confusion.csv and its misses to path-misses.csv
+    """
+    with open(path + ".json", "w") as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+    with open(path + "-classes.csv", "w") as out:
+        writer = csv.writer(out)
+        writer.writerow(["class", "precision", "recall", "f1", "support"])
+        for row in report["classes"]:
+            writer.writerow([row["class"], "%.6f" % row["precision"],
+                             "%.6f" % row["recall"], "%.6f" % row["f1"], row["support"]])
+    with open(path + "-confusion.csv", "w") as out:
+        writer = csv.writer(out)
+        writer.writerow(["expected\\predicted"] + util.malware_classes)
+        for name, row in zip(util.malware_classes, report["confusion_matrix"]):
+            writer.writerow([name] + row)
+    with open(path + "-misses.csv", "w") as out:
+        writer = csv.writer(out)
+        writer.writerow(["id", "expected", "predicted"])
+        for miss in report["misses"]:
+            writer.writerow([miss["id"], util.malware_classes[miss["expected"]],
+                             util.malware_classes[miss["predicted"]]])
+
+def print_summary(report):
+    print "Correct: %d, Incorrect: %d, Total: %d, Accuracy: %f, Macro-F1: %f" % (
+        report["correct"], report["total"] - report["correct"], report["total"],
+        report["accuracy"], report["macro_f1"])
+    print "%-10s %9s %9s %9s %8s" % ("class", "precision", "recall", "f1", "support")
+    for row in report["classes"]:
+        if row["support"]:
+            print "%-10s %9.3f %9.3f %9.3f %8d" % (row["class"], row["precision"],
+                                                   row["recall"], row["f1"], row["support"])
+    if report["predict_seconds"] is not None:
+        print "Predicted in %.3fs, evaluated in %.3fs" % (report["predict_seconds"],
+                                                          report["evaluate_seconds"])
@@ -1,6 +1,8 @@
 #!/usr/bin/python
 
-from collections import Counter
+import re
+import weakref
+from collections import Counter, deque
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
@@ -13,72 +15,732 @@ def extractor(feature_extractor):
     ffs.append(feature_extractor)
     return feature_extractor
 
+# Big traces can be split into consecutive runs of processes that are
+# extracted separately (see scheduling.py). An extractor that can rebuild its
+# features for the whole trace from the features of the pieces says how with
+# @merged_by(merge), where merge takes the pieces' Counters in document order.
+# Extractors without one make their traces be extracted whole.
+def merged_by(merge):
+    def mark(feature_extractor):
+        feature_extractor.merge = merge
+        return feature_extractor
+    return mark
+
+# Extractors can also say how to get their features without a parsed tree, so
+# that fastparse.py can stream through a trace without building any elements:
+# @on_index for extractors that only look at the process_index of their tree
+# (they then get called with a ProcessIndex instead). Everything that only
+# looks at individual elements is a @fused handler instead (see fused_pass),
+# which fastparse runs on each element as it goes by.
+def on_index(feature_extractor):
+    feature_extractor.from_index = True
+    return feature_extractor
+
+# @windowed marks an @on_index extractor that also reads the index's
+# CallWindows, which are only kept when one of the extractors in use needs them
+def windowed(feature_extractor):
+    feature_extractor.needs_windows = True
+    return feature_extractor
+
+def wants_windows(ffs):
+    return any(getattr(ff, "needs_windows", False) for ff in ffs)
+
+# Extractors also say how costly they are with @tier(n): tier 1 for cheap
+# counts that are still telling on a partial parse of a trace, higher tiers
+# for the rest (the default is DEFAULT_TIER). See lazy.py.
+DEFAULT_TIER = 2
+
+def tier(n):
+    def mark(feature_extractor):
+        feature_extractor.tier = n
+        return feature_extractor
+    return mark
+
+def tier_of(feature_extractor):
+    return getattr(feature_extractor, "tier", DEFAULT_TIER)
+
+def sum_parts(parts):
+    """
+    Merge for plain counts: the trace's count is the sum over its pieces
+    """
+    c = Counter()
+    for part in parts:
+        c.update(part)
+    return c
+
 """
 DLL file & address location
-Registry key access
-web addresses
-
+Registry key access (reg_key_final_name)
+web addresses (net_connects, url_domains)
+file system activity (file_targets)
 """
 
+## The process index
+## -----------------
+## A trace is a list of processes, each holding threads, each holding one
+## all_section with that thread's syscalls in order. ProcessIndex walks that
+## structure once and keeps a compact summary of it, so extractors that care
+## about calls, processes or threads can share one walk instead of each doing
+## their own tree.iter() (and having to track which section they are in).
+
+class ThreadInfo(object):
+    """
+    What we keep about one thread: its syscall counts in a Counter, the first
+    and last call it made and how many calls it made in total
+    """
+    __slots__ = ("tid", "calls", "first_call", "last_call", "num_calls")
+
+    def __init__(self, tid):
+        self.tid = tid
+        self.calls = Counter()
+        self.first_call = None
+        self.last_call = None
+        self.num_calls = 0
+
+class ProcessInfo(object):
+    """
+    What we keep about one process: its identity, where it sits in the
+    process tree (parent and children are positions in ProcessIndex.processes),
+    its lifetime in seconds and its threads
+    """
+    __slots__ = ("pid", "filename", "startreason", "parent", "children",
+                 "depth", "starttime", "terminationtime", "threads")
+
+    def __init__(self, attrib):
+        self.pid = attrib.get("pid")
+        self.filename = attrib.get("filename", "").split("\\")[-1].lower()
+        self.startreason = attrib.get("startreason")
+        self.parent = None
+        self.children = []
+        self.depth = 0
+        self.starttime = parse_trace_time(attrib.get("starttime"))
+        self.terminationtime = parse_trace_time(attrib.get("terminationtime"))
+        self.threads = []
+
+    def lifetime(self):
+        if self.starttime is None or self.terminationtime is None:
+            return None
+        return self.terminationtime - self.starttime
+
+    def calls(self):
+        """
+        Syscall histogram over all of this process's threads
+        """
+        c = Counter()
+        for thread in self.threads:
+            c.update(thread.calls)
+        return c
+
+    def num_calls(self):
+        return sum(thread.num_calls for thread in self.threads)
+
+def parse_trace_time(stamp):
+    """
+    Turns a trace timestamp like '01:02.500' into seconds (62.5)
+    """
+    if not stamp:
+        return None
+    seconds = 0.0
+    try:
+        for part in stamp.split(":"):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        return None
+    return seconds
+
+# window sizes for windowed_call_feats
+WINDOW_CALLS = 200
+NUM_SEGMENTS = 4
+
+class CallWindows(object):
+    """
+    The first first_n calls of a trace, its last last_n calls and syscall
+    histograms over num_segments consecutive segments of it, kept as the
+    calls stream by in order, in memory that doesn't grow with the trace.
+
+    The first calls are a list, the last a circular buffer (a deque with
+    maxlen), so both keep their order and the windows of consecutive pieces
+    of a trace can be joined exactly (see windowed_parts). Since the
+    length of the trace isn't known until it ends, the segments are built
+    from up to 2 * resolution * num_segments buckets of width calls each:
+    whenever they are all full, neighbouring buckets are merged and the width
+    doubles. In the end each bucket goes to the segment its middle falls in,
+    so segment boundaries are off by at most one bucket, which is under
+    1 / (resolution * num_segments) of the trace (and exact for short ones).
+    """
+    def __init__(self, first_n=WINDOW_CALLS, last_n=WINDOW_CALLS,
+                 num_segments=NUM_SEGMENTS, resolution=8):
+        self.first_n = first_n
+        self.num_segments = num_segments
+        self.max_buckets = 2 * resolution * num_segments
+        self.first = []
+        self.last = deque(maxlen=last_n)
+        self.num_calls = 0
+        self.buckets = []
+        self.current = Counter()
+        self.filled = 0
+        self.width = 1
+
+    def extend(self, tags):
+        """
+        Adds a list of calls, in the order they were made
+        """
+        if len(self.first) < self.first_n:
+            self.first.extend(tags[:self.first_n - len(self.first)])
+        self.num_calls += len(tags)
+        self.last.extend(tags)
+        i = 0
+        while i < len(tags):
+            chunk = tags[i:i + self.width - self.filled]
+            self.current.update(chunk)
+            self.filled += len(chunk)
+            i += len(chunk)
+            if self.filled == self.width:
+                self.buckets.append(self.current)
+                self.current = Counter()
+                self.filled = 0
+                if len(self.buckets) == self.max_buckets:
+                    self.buckets = [self.buckets[j] + self.buckets[j + 1]
+                                    for j in xrange(0, len(self.buckets), 2)]
+                    self.width *= 2
+
+    def sized_buckets(self):
+        """
+        returns the buckets so far as a list of (number of calls, Counter)
+        """
+        sized = [(self.width, bucket) for bucket in self.buckets]
+        if self.filled:
+            sized.append((self.filled, self.current))
+        return sized
+
+    def segments(self):
+        """
+        returns a list of num_segments Counters, one per segment of the calls
+        """
+        return assign_segments(self.sized_buckets(), self.num_calls, self.num_segments)
+
+def assign_segments(sized_buckets, num_calls, num_segments):
+    """
+    Adds each of the consecutive (size, Counter) buckets of num_calls calls to
+    the segment its middle falls in. returns the num_segments Counters.
+    """
+    segments = [Counter() for _ in xrange(num_segments)]
+    start = 0
+    for size, bucket in sized_buckets:
+        middle2 = 2 * start + size
+        segments[min(num_segments - 1, middle2 * num_segments // (2 * num_calls))].update(bucket)
+        start += size
+    return segments
+
+class ProcessIndex(object):
+    """
+    arguments:
+      tree is an xml.etree.ElementTree object
+    builds, in one walk over the processes/threads/all_sections of tree:
+      processes - a list of ProcessInfo in document order
+      roots     - positions of the processes with no parent in the trace
+      calls     - syscall histogram over the whole trace
+      first_call, last_call, num_calls - over the whole trace, in document order
+      windows   - a CallWindows over every call of the trace, in document
+                  order, if windows is set (None otherwise)
+    With no tree, the index is built up by calling add_process, add_calls,
+    add_thread and finish as a parser streams through a trace (see
+    fastparse.py).
+    """
+    def __init__(self, tree=None, windows=False):
+        self.processes = []
+        self.roots = []
+        self.calls = Counter()
+        self.first_call = None
+        self.last_call = None
+        self.num_calls = 0
+        self.windows = CallWindows() if windows else None
+        self._by_index = {}
+        self._by_pid = {}
+        self._parents = []
+        if tree is None:
+            return
+
+        for proc_el in tree.getroot().iter("process"):
+            proc = self.add_process(proc_el.attrib)
+            for thread_el in proc_el.iter("thread"):
+                thread = ThreadInfo(thread_el.get("tid"))
+                for section in thread_el.iter("all_section"):
+                    # only direct children are syscalls, anything nested
+                    # below one is one of its arguments
+                    self.add_calls(thread, [el.tag for el in section])
+                self.add_thread(proc, thread)
+        self.finish()
+
+    def add_process(self, attrib):
+        """
+        Adds the process with the given attributes and returns its ProcessInfo
+        """
+        proc = ProcessInfo(attrib)
+        self._by_index[attrib.get("index")] = len(self.processes)
+        self._by_pid.setdefault(proc.pid, len(self.processes))
+        self._parents.append((attrib.get("parentindex"), attrib.get("parentpid")))
+        self.processes.append(proc)
+        return proc
+
+    def add_calls(self, thread, tags):
+        """
+        Adds the calls of one all_section of thread, in order
+        """
+        if not tags:
+            return
+        thread.calls.update(tags)
+        if thread.first_call is None:
+            thread.first_call = tags[0]
+        thread.last_call = tags[-1]
+        if self.windows is not None:
+            self.windows.extend(tags)
+
+    def add_thread(self, proc, thread):
+        """
+        Adds a thread of proc once all of its calls have been counted
+        """
+        thread.num_calls = sum(thread.calls.itervalues())
+        proc.threads.append(thread)
+        self.calls.update(thread.calls)
+        self.num_calls += thread.num_calls
+        if thread.num_calls:
+            if self.first_call is None:
+                self.first_call = thread.first_call
+            self.last_call = thread.last_call
+
+    def finish(self):
+        """
+        Hooks up the process tree now that every process has a position
+        """
+        for pos, (parentindex, parentpid) in enumerate(self._parents):
+            parent = self._by_index.get(parentindex)
+            if parent is None:
+                parent = self._by_pid.get(parentpid)
+            if parent is None or parent == pos:
+                self.roots.append(pos)
+            else:
+                self.processes[pos].parent = parent
+                self.processes[parent].children.append(pos)
+        stack = [(pos, 0) for pos in self.roots]
+        while stack:
+            pos, depth = stack.pop()
+            self.processes[pos].depth = depth
+            stack.extend((child, depth + 1) for child in self.processes[pos].children)
+        self._by_index = self._by_pid = self._parents = None
+
+    def threads(self):
+        for proc in self.processes:
+            for thread in proc.threads:
+                yield thread
+
+    def subtree(self, pos):
+        """
+        Positions of the process at pos and all of its descendants
+        """
+        out = []
+        stack = [pos]
+        while stack:
+            pos = stack.pop()
+            out.append(pos)
+            stack.extend(self.processes[pos].children)
+        return out
+
+# a weak reference to the last tree indexed and its index, so every extractor
+# run on the same tree shares one walk (without keeping the tree alive once
+# extract_feats moves on to the next file)
+_index_cache = [lambda: None, None]
+
+def process_index(tree, windows=False):
+    """
+    Returns the ProcessIndex of tree, building it only if tree isn't the
+    tree we were last asked about (or windows are wanted and that index has
+    none). tree may also be an already built ProcessIndex, which is returned
+    as is.
+    """
+    if isinstance(tree, ProcessIndex):
+        return tree
+    if _index_cache[0]() is not tree or (windows and _index_cache[1].windows is None):
+        _index_cache[1] = ProcessIndex(tree, windows)
+        _index_cache[0] = weakref.ref(tree)
+    return _index_cache[1]
+
+def index_for(tree, ffs):
+    """
+    Builds the process index of tree up front for running ffs on it, with
+    call windows only if one of ffs needs them, so they all share one walk
+    """
+    if any(getattr(ff, "from_index", False) for ff in ffs):
+        process_index(tree, wants_windows(ffs))
+
+# syscall_count's features are named SYSCALL_PREFIX + call, so the plain
+# counts can be told apart from every other feature (see cascade.py)
+SYSCALL_PREFIX = "call-"
+
 @extractor
+@merged_by(sum_parts)
+@on_index
+@tier(1)
 def syscall_count(tree):
     """
     Counts the number of each system call and returns the result as a Counter
-    (dict) mapping 'sys_call': count
+    (dict) mapping 'call-sys_call': count
+    """
+    return Counter(dict((SYSCALL_PREFIX + call, count)
+                        for call, count in process_index(tree).calls.iteritems()))
+
+# processes deeper than this in the process tree share their features
+MAX_PROC_DEPTH = 2
+PROC_CALL_RE = re.compile(r"^proc[0-9]+-")
+
+def process_feats_parts(parts):
+    """
+    Every piece of a split trace sees the attributes of all of its processes
+    but only the threads of its own, so per-process call counts and thread
+    counts add up while everything else is the same in (or maxed over) every
+    piece
     """
     c = Counter()
-    in_all_section = False
-    for el in tree.iter():
-        # ignore everything outside the "all_section" element
-        if el.tag == "all_section" and not in_all_section:
-            in_all_section = True
-        elif el.tag == "all_section" and in_all_section:
-            in_all_section = False
-        elif in_all_section:
-            # Increment our count of this syscall
-            c[el.tag] += 1
-            
+    for part in parts:
+        for feat, val in part.iteritems():
+            if feat == "num_threads" or PROC_CALL_RE.match(feat):
+                c[feat] += val
+            else:
+                c[feat] = max(c[feat], val)
     return c
 
 @extractor
-def dll_loads(tree):
+@merged_by(process_feats_parts)
+@on_index
+def process_feats(tree):
     """
-    Counts how many times a dll gets loaded by each program (should be 1 or 0)
+    Features of the process/thread structure of a trace: per-process syscall
+    histograms keyed by how deep the process is in the process tree
+    ('proc0-load_dll' for the analysis target, 'proc1-...' for its children
+    and so on), how processes were started, and counts and lifetimes of
+    processes and threads
     """
+    index = process_index(tree)
     c = Counter()
-    for el in tree.iter():
-        if el.tag == "load_dll" and "filename" in el.attrib:
-            file_path = el.attrib["filename"]
-            # Get the last part which should be *.dll
-            file_name = file_path.split("\\")[-1].lower()
-            # Soft assertion
-            # if (len(file_name) != 0 and "dll" not in file_name):
-            #     print "Bad dll: %s" % file_path
-            c[file_name] += 1
+    for proc in index.processes:
+        prefix = "proc%d-" % min(proc.depth, MAX_PROC_DEPTH)
+        for call, count in proc.calls().iteritems():
+            c[prefix + call] += count
+        if proc.startreason:
+            c["proc_start-" + proc.startreason] += 1
+        c["max_threads_per_proc"] = max(c["max_threads_per_proc"], len(proc.threads))
+        c["max_proc_depth"] = max(c["max_proc_depth"], proc.depth)
+    c["num_processes"] = len(index.processes)
+    c["num_threads"] = sum(len(proc.threads) for proc in index.processes)
+    lifetimes = [proc.lifetime() for proc in index.processes]
+    lifetimes = [t for t in lifetimes if t is not None]
+    if lifetimes:
+        c["max_proc_lifetime"] = max(lifetimes)
     return c
 
-@extractor
-def reg_key_final_name(tree):
-    return Counter();
+class KeyTrie(object):
+    """
+    A prefix trie of normalized registry key paths. One trie is shared by every
+    file we extract, so each distinct path is stored once no matter how many
+    traces touch it, as a chain of nodes each holding one component, and each
+    distinct component string is kept once however many paths it is on. Nodes
+    are plain ints indexing into parallel lists, which keeps them much smaller
+    than a dict/object per node. Full path strings are never stored: feature
+    names are joined from the components when a key is counted, and path()
+    rebuilds a node's path from its parents.
+
+    max_nodes bounds the trie: once it is full, new paths are not added, but
+    their components are still returned in full, so a key's features never
+    depend on which paths got in first (that depends on the order traces are
+    visited in, and in parallel on which worker saw which). What the trie and
+    its cache hold is bounded by max_nodes nodes and cache_size cached keys;
+    the components of keys past the cap are only kept by the cache, and their
+    names only by the Counters that count them. Cutting down the rare paths
+    is left to FeatureSelector, which sees counts over the whole training
+    matrix.
+    """
+    def __init__(self, max_nodes=500000, cache_size=10000):
+        self.max_nodes = max_nodes
+        self.cache_size = cache_size
+        self._cache = {}        # raw key -> components, for keys hit over and over
+        self._components = {}   # the one shared copy of each component string
+        self.children = [{}]    # node -> {component: child node}
+        self.parent = [-1]
+        self.label = [""]
+
+    def __len__(self):
+        return len(self.children)
+
+    def insert(self, components):
+        """
+        Inserts the path given as a list of components, as far as max_nodes
+        allows, and returns its components, shared with the trie's copies
+        where it has them
+        """
+        node = 0
+        path = []
+        for comp in components:
+            if node is not None:
+                child = self.children[node].get(comp)
+                if child is None and len(self.children) < self.max_nodes:
+                    comp = self._components.setdefault(comp, comp)
+                    child = len(self.children)
+                    self.children[node][comp] = child
+                    self.children.append({})
+                    self.parent.append(node)
+                    self.label.append(comp)
+                if child is not None:
+                    comp = self.label[child]
+                node = child
+            path.append(comp)
+        return path
+
+    def lookup(self, key):
+        """
+        Normalizes a raw registry key and inserts it, returning its
+        components. Recently seen raw keys skip the normalization entirely;
+        the cache is simply dropped whenever it grows past cache_size.
+        """
+        path = self._cache.get(key)
+        if path is None:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            path = self._cache[key] = self.insert(normalize_reg_key(key))
+        return path
+
+    def path(self, node):
+        comps = []
+        while node > 0:
+            comps.append(self.label[node])
+            node = self.parent[node]
+        return "\\".join(reversed(comps))
+
+# registry hives show up under a few different spellings
+REG_HIVES = {
+    "hkey_local_machine": "hklm", "hklm": "hklm", "machine": "hklm",
+    "hkey_current_user": "hkcu", "hkcu": "hkcu",
+    "hkey_users": "hku", "hku": "hku", "user": "hku",
+    "hkey_classes_root": "hkcr", "hkcr": "hkcr",
+    "hkey_current_config": "hkcc", "hkcc": "hkcc",
+}
+REG_TAGS = set(["open_key", "create_key", "delete_key", "enum_keys",
+                "query_value", "set_value", "delete_value", "enum_values"])
+# depths of the prefixes we emit as features; None means the full path
+REG_KEY_DEPTHS = (1, 2, None)
+SID_RE = re.compile(r"^s-1-[0-9-]+(_classes)?$")
+GUID_RE = re.compile(r"^\{[0-9a-f-]+\}$")
+
+reg_trie = KeyTrie()
+
+def normalize_reg_key(key):
+    """
+    Splits a registry key into lowercase components, folding the various
+    spellings of each hive together and replacing user SIDs and GUIDs with
+    placeholders so that they don't each become their own feature
+    """
+    comps = [comp for comp in key.strip().lower().split("\\") if comp]
+    if comps and comps[0] == "registry":
+        comps = comps[1:]
+    if comps:
+        comps[0] = REG_HIVES.get(comps[0], comps[0])
+    for i in xrange(1, len(comps)):
+        if SID_RE.match(comps[i]):
+            comps[i] = "<sid>"
+        elif GUID_RE.match(comps[i]):
+            comps[i] = "<guid>"
+    return comps
+
+def reg_key_feats(keys, trie=None, depths=REG_KEY_DEPTHS):
+    """
+    Turns an iterable of raw registry keys into features: 'reg_key1-hklm'
+    style prefix counts for each depth in depths, 'reg_key-<path>' for full
+    paths and 'reg_key_name-<name>' for the final component of each key
+    """
+    trie = trie if trie is not None else reg_trie
+    c = Counter()
+    for key in keys:
+        add_reg_key(c, trie.lookup(key), depths)
+    return c
+
+def add_reg_key(c, path, depths=REG_KEY_DEPTHS):
+    if not path:
+        return
+    for depth in depths:
+        if depth is None:
+            c["reg_key-" + "\\".join(path)] += 1
+        elif depth <= len(path):
+            c["reg_key%d-%s" % (depth, "\\".join(path[:depth]))] += 1
+    c["reg_key_name-" + path[-1]] += 1
+
+## The fused pass
+## --------------
+## Every @extractor walks the whole tree on its own, which adds up fast on the
+## big traces. Extractors that only need to look at individual syscalls should
+## instead register a handler for the tags they care about with @fused(...).
+## fused_pass() then walks the tree once and hands each matching syscall's tag
+## and attributes to its handlers, which add their features to a shared Counter.
+## With the process index, that makes two walks of each tree whatever the
+## number of extractors.
+fused_handlers = {}     # tag -> list of handler(tag, attrib, c)
+
+def fused(*tags):
+    """
+    Registers the decorated handler(tag, attrib, c) to run on every syscall
+    with one of the given tags during fused_pass
+    """
+    def register(handler):
+        for tag in tags:
+            fused_handlers.setdefault(tag, []).append(handler)
+        return handler
+    return register
+
+class AttrMatcher(object):
+    """
+    Pulls a value out of a syscall's attributes. The first non-empty attribute
+    among attrs is used, so one matcher covers the different names a field
+    goes by across syscalls. If a pattern is given it is compiled up front and
+    the value becomes its first group (or None if it doesn't match).
+    """
+    def __init__(self, attrs, pattern=None, lower=True):
+        self.attrs = tuple(attrs)
+        self.pattern = re.compile(pattern) if pattern is not None else None
+        self.lower = lower
+
+    def __call__(self, attrib):
+        for attr in self.attrs:
+            value = attrib.get(attr)
+            if value:
+                break
+        else:
+            return None
+        if self.lower:
+            value = value.lower()
+        if self.pattern is not None:
+            match = self.pattern.search(value)
+            if match is None:
+                return None
+            value = match.group(1)
+        return value
 
 @extractor
-def reg_values(tree):
+@merged_by(sum_parts)
+def fused_pass(tree):
     """
-    Looks at syscalls to 'query_value' and counts how many times each value was accessed
+    Walks the tree once, running the @fused handlers registered for each
+    syscall's tag, and returns the union of their features
     """
     c = Counter()
     for el in tree.iter():
-        if el.tag == "query_value" and "value" in el.attrib:
-            # Increment our count of this syscall
-            c[el.attrib["value"]] += 1
-            
+        hs = fused_handlers.get(el.tag)
+        if hs is not None:
+            for handler in hs:
+                handler(el.tag, el.attrib, c)
     return c
 
+reg_key_match = AttrMatcher(["key"], lower=False)
+
+@fused(*REG_TAGS)
+def reg_key_final_name(tag, attrib, c):
+    """
+    Counts accesses to registry keys, at the hive, top-level key and full path
+    level, plus the final name of each key (see reg_key_feats)
+    """
+    key = reg_key_match(attrib)
+    if key is not None:
+        add_reg_key(c, reg_trie.lookup(key))
+
+FILE_OPS = {"open_file": "open", "create_file": "create", "delete_file": "delete"}
+file_match = AttrMatcher(["srcfile", "filename", "dstfile"],
+                         r"([^\\/]*)$")
+ext_match = re.compile(r"\.([a-z0-9]{1,5})$")
+
+@fused(*FILE_OPS)
+def file_targets(tag, attrib, c):
+    """
+    Counts files opened, created or deleted by name ('file_open-foo.dll') and
+    by extension ('file_open_ext-dll')
+    """
+    name = file_match(attrib)
+    if not name:
+        return
+    op = FILE_OPS[tag]
+    c["file_%s-%s" % (op, name)] += 1
+    ext = ext_match.search(name)
+    if ext is not None:
+        c["file_%s_ext-%s" % (op, ext.group(1))] += 1
+
+host_match = AttrMatcher(["host", "hostname", "remotehost", "remoteaddr",
+                          "address", "name"])
+port_match = AttrMatcher(["port", "remoteport"])
+
+@fused("connect", "connect_socket", "get_host_by_name", "get_host_by_addr")
+def net_connects(tag, attrib, c):
+    """
+    Counts network connections and lookups by host ('net_host-1.2.3.4') and
+    by port ('net_port-80')
+    """
+    host = host_match(attrib)
+    if host is not None:
+        c["net_host-" + host] += 1
+    port = port_match(attrib)
+    if port is not None:
+        c["net_port-" + port] += 1
+
+url_domain_match = AttrMatcher(["url", "hostname", "host"],
+                               r"^(?:[a-z]+://)?(?:www\.)?([^/:?#]+)")
+
+@fused("open_url", "download_file", "download_file_to_cache", "internet_open_url")
+def url_domains(tag, attrib, c):
+    """
+    Counts the domains of the urls a program opens ('url_domain-example.com')
+    """
+    domain = url_domain_match(attrib)
+    if domain is not None:
+        c["url_domain-" + domain] += 1
+
+@fused("load_dll")
+def dll_loads(tag, attrib, c):
+    """
+    Counts how many times a dll gets loaded by each program (should be 1 or 0)
+    """
+    if "filename" in attrib:
+        file_path = attrib["filename"]
+        # Get the last part which should be *.dll
+        file_name = file_path.split("\\")[-1].lower()
+        # Soft assertion
+        # if (len(file_name) != 0 and "dll" not in file_name):
+        #     print "Bad dll: %s" % file_path
+        c[file_name] += 1
+
+@fused("query_value")
+def reg_values(tag, attrib, c):
+    """
+    Looks at syscalls to 'query_value' and counts how many times each value was accessed
+    """
+    if "value" in attrib:
+        # Increment our count of this syscall
+        c[attrib["value"]] += 1
+
 ## Here are two example feature-functions. They each take an xml.etree.ElementTree object, 
 # (i.e., the result of parsing an xml file) and returns a dictionary mapping 
 # feature-names to numeric values.
 ## TODO: modify these functions, and/or add new ones.
+def first_last_parts(parts):
+    """
+    The first call of the whole trace is the first call of the first piece
+    that made any, the last call is that of the last one
+    """
+    c = Counter()
+    firsts = [feat for part in parts for feat in part if feat.startswith("first_call-")]
+    lasts = [feat for part in parts for feat in part if feat.startswith("last_call-")]
+    if firsts:
+        c[firsts[0]] = 1
+        c[lasts[-1]] = 1
+    return c
+
 @extractor
+@merged_by(first_last_parts)
+@on_index
 def first_last_system_call_feats(tree):
     """
     arguments:
@@ -90,26 +752,16 @@ def first_last_system_call_feats(tree):
       last system calls made by an executable were.)
     """
     c = Counter()
-    in_all_section = False
-    first = True # is this the first system call
-    last_call = None # keep track of last call we've seen
-    for el in tree.iter():
-        # ignore everything outside the "all_section" element
-        if el.tag == "all_section" and not in_all_section:
-            in_all_section = True
-        elif el.tag == "all_section" and in_all_section:
-            in_all_section = False
-        elif in_all_section:
-            if first:
-                c["first_call-"+el.tag] = 1
-                first = False
-            last_call = el.tag  # update last call seen
-            
-    # finally, mark last call seen
-    c["last_call-"+last_call] = 1
+    index = process_index(tree)
+    if index.first_call is not None:
+        c["first_call-"+index.first_call] = 1
+        c["last_call-"+index.last_call] = 1
     return c
 
 @extractor
+@merged_by(sum_parts)
+@on_index
+@tier(1)
 def system_call_count_feats(tree):
     """
     arguments:
@@ -119,13 +771,58 @@ def system_call_count_feats(tree):
       made by an executable (summed over all processes)
     """
     c = Counter()
-    in_all_section = False
-    for el in tree.iter():
-        # ignore everything outside the "all_section" element
-        if el.tag == "all_section" and not in_all_section:
-            in_all_section = True
-        elif el.tag == "all_section" and in_all_section:
-            in_all_section = False
-        elif in_all_section:
-            c['num_system_calls'] += 1
+    c['num_system_calls'] = process_index(tree).num_calls
+    return c
+
+class WindowCounts(Counter):
+    """
+    windowed_call_feats' features, with the CallWindows they came from for
+    windowed_parts (kept when pickled, unlike a plain Counter's attributes)
+    """
+    def __reduce__(self):
+        return self.__class__, (dict(self),), {"windows": getattr(self, "windows", None)}
+
+def window_feats(first, last, segments, first_n=WINDOW_CALLS, last_n=WINDOW_CALLS):
+    c = WindowCounts()
+    for call in first:
+        c["first%d-%s" % (first_n, call)] += 1
+    for call in last:
+        c["last%d-%s" % (last_n, call)] += 1
+    for i, segment in enumerate(segments):
+        for call, count in segment.iteritems():
+            c["segment%d-%s" % (i, call)] = count
+    return c
+
+def windowed_parts(parts):
+    """
+    The first calls of the whole trace are the first ones of the pieces in
+    order and the last calls the last ones; the segments are rebuilt from
+    every piece's buckets, so their boundaries are off by at most one bucket
+    of one piece, as for a trace extracted whole
+    """
+    windows = [part.windows for part in parts]
+    first_n, last_n = windows[0].first_n, windows[0].last.maxlen
+    first = [call for w in windows for call in w.first][:first_n]
+    last = deque((call for w in windows for call in w.last), maxlen=last_n)
+    num_calls = sum(w.num_calls for w in windows)
+    segments = [Counter() for _ in xrange(windows[0].num_segments)]
+    if num_calls:
+        segments = assign_segments([sized for w in windows for sized in w.sized_buckets()],
+                                   num_calls, windows[0].num_segments)
+    return window_feats(first, last, segments, first_n, last_n)
+
+@extractor
+@merged_by(windowed_parts)
+@on_index
+@windowed
+def windowed_call_feats(tree):
+    """
+    Syscall histograms over the first and last WINDOW_CALLS calls of a trace
+    ('first200-load_dll', 'last200-load_dll') and over each of NUM_SEGMENTS
+    equal parts of it ('segment0-load_dll' and so on)
+    """
+    windows = process_index(tree, windows=True).windows
+    c = window_feats(windows.first, windows.last, windows.segments(),
+                     windows.first_n, windows.last.maxlen)
+    c.windows = windows
     return c
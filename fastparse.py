@@ -0,0 +1,231 @@
+## Streaming parsers
+## -----------------
+## ET.parse builds an Element, with its own attribute dict, for every syscall
+## in a trace before any extractor gets to look at it, and then the extractors
+## walk that tree again. When every extractor says how to get its features
+## without a tree (on_index, or fused_pass in extractors.py), stream_feats
+## skips the tree altogether: a parser streams through the trace once, the
+## ProcessIndex is built up as processes, threads and calls go by, and each
+## element whose tag some @fused handler asked for has its tag and attributes
+## handed straight to the handlers.
+##
+## Two backends:
+##   "expat" - the C parser under ElementTree, driven directly through
+##             callbacks, so no Element is ever built, though a Python
+##             callback still runs at the start and end of every element
+##             (always available)
+##   "lxml"  - lxml's iterparse, reporting only process and thread events;
+##             lxml still builds every element under them, so each thread
+##             is walked and freed as soon as it ends. Only elements inside
+##             threads reach the handlers. Needs lxml.
+##
+## What this saves is memory: the whole tree of a trace is never held, so a
+## 16MB synthetic trace peaks at about 21MB (expat) or 26MB (lxml) of RSS
+## against 153MB for ET.parse. It is not much faster. Most of the time goes
+## to the extractors' own handlers, which both ways run, and the per-element
+## callbacks cost about what building and walking the tree in C does:
+## bench_parse.py measured expat at 0.9-1.2x the speed of the ET path on the
+## synthetic corpus, up to 1.2x on 16MB traces, and lxml about the same.
+##
+## stream_feats returns the same feature dict as running the extractors on
+## ET.parse of the trace; bench_parse.py checks that and times the backends.
+
+from collections import Counter
+from xml.parsers import expat
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+from extractors import ProcessIndex, ThreadInfo, wants_windows, fused_pass, fused_handlers
+
+BACKENDS = ("expat", "lxml")
+
+def streamable(ffs):
+    """
+    True if every extractor in ffs can be run on a stream
+    """
+    return all(getattr(ff, "from_index", False) or ff is fused_pass for ff in ffs)
+
+def available(backend):
+    return backend == "expat" or (backend == "lxml" and lxml_etree is not None)
+
+class TraceStream(object):
+    """
+    The state of one pass over a trace: the ProcessIndex being built (if any
+    extractor needs one), the process, thread and all_section we are in, and
+    for each tag the (handler, Counter) pairs of the @fused handlers that
+    asked for it
+    """
+    def __init__(self, ffs):
+        self.ffs = ffs
+        self.counters = {}
+        self.dispatch = {}
+        for ff in ffs:
+            if getattr(ff, "from_index", False):
+                continue
+            c = self.counters[ff] = Counter()
+            for tag, handlers in fused_handlers.iteritems():
+                self.dispatch.setdefault(tag, []).extend((h, c) for h in handlers)
+        needs_index = any(getattr(ff, "from_index", False) for ff in ffs)
+        self.index = ProcessIndex(windows=wants_windows(ffs)) if needs_index else None
+        self.proc = None
+        self.thread = None
+        self.depth = 0
+        # depth of the elements that are syscalls, while in an all_section,
+        # and the calls of that section so far
+        self.call_depth = None
+        self.section_calls = None
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.depth == self.call_depth:
+            self.section_calls.append(tag)
+        elif tag == "process":
+            self.proc = self.index.add_process(attrib)
+        elif tag == "thread":
+            self.thread = ThreadInfo(attrib.get("tid"))
+        elif tag == "all_section" and self.thread is not None:
+            self.call_depth = self.depth + 1
+            self.section_calls = []
+        hs = self.dispatch.get(tag)
+        if hs is not None:
+            for handler, c in hs:
+                handler(tag, attrib, c)
+
+    def end(self, tag):
+        if self.depth + 1 == self.call_depth and tag == "all_section":
+            self.index.add_calls(self.thread, self.section_calls)
+            self.call_depth = None
+            self.section_calls = None
+        elif tag == "thread" and self.thread is not None:
+            if self.proc is not None:
+                self.index.add_thread(self.proc, self.thread)
+            self.thread = None
+        self.depth -= 1
+
+    def dispatch_only(self, tag, attrib):
+        hs = self.dispatch.get(tag)
+        if hs is not None:
+            for handler, c in hs:
+                handler(tag, attrib, c)
+
+    def add_lxml_thread(self, thread_el):
+        """
+        Counts the calls of a whole thread element and runs the handlers of
+        everything in it (lxml backend)
+        """
+        if self.index is not None and self.proc is not None:
+            thread = ThreadInfo(thread_el.get("tid"))
+            for section in thread_el.iter("all_section"):
+                self.index.add_calls(thread, [el.tag for el in section])
+            self.index.add_thread(self.proc, thread)
+        if self.dispatch:
+            for el in thread_el.iter():
+                hs = self.dispatch.get(el.tag)
+                if hs is not None:
+                    for handler, c in hs:
+                        handler(el.tag, el.attrib, c)
+
+    def flush(self):
+        """
+        Closes the section and thread we were in when the input was cut
+        short, so their calls still count
+        """
+        if self.call_depth is not None:
+            self.index.add_calls(self.thread, self.section_calls)
+            self.call_depth = None
+            self.section_calls = None
+        if self.thread is not None and self.proc is not None:
+            self.index.add_thread(self.proc, self.thread)
+        self.thread = None
+
+    def results(self):
+        """
+        What each extractor would have returned on the parsed trace, in order
+        """
+        if self.index is not None:
+            self.index.finish()
+        return [ff(self.index) if getattr(ff, "from_index", False) else self.counters[ff]
+                for ff in self.ffs]
+
+def _stream_expat(stream, source, max_bytes=None, block_size=1 << 16):
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    if stream.index is None:
+        parser.StartElementHandler = stream.dispatch_only
+    else:
+        parser.StartElementHandler = stream.start
+        parser.EndElementHandler = stream.end
+    if max_bytes is None:
+        parser.ParseFile(source)
+        return
+    # feed at most max_bytes and never tell expat the input is over, so a
+    # trace cut off mid-element is not a syntax error
+    left = max_bytes
+    while left > 0:
+        block = source.read(min(block_size, left))
+        if not block:
+            parser.Parse("", True)
+            break
+        parser.Parse(block, False)
+        left -= len(block)
+    if stream.index is not None:
+        stream.flush()
+
+def _stream_lxml(stream, source):
+    if lxml_etree is None:
+        raise ValueError("The lxml backend needs lxml installed")
+    # the tag filter only drops the other events, every element is still
+    # built, so threads are cleared once walked and processes once they end
+    for event, el in lxml_etree.iterparse(source, events=("start", "end"),
+                                          tag=("process", "thread")):
+        if el.tag == "process":
+            if event == "start":
+                if stream.index is not None:
+                    stream.proc = stream.index.add_process(el.attrib)
+                stream.dispatch_only(el.tag, el.attrib)
+            else:
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+        elif event == "end":
+            stream.add_lxml_thread(el)
+            el.clear()
+
+def stream_results(ffs, source, backend="expat", max_bytes=None):
+    """
+    arguments:
+      ffs are feature-functions that are all streamable(ffs)
+      source is the path of a trace, or an open file holding one
+      backend is "expat" or "lxml"
+      max_bytes stops after the first max_bytes of the trace, as if it ended
+        there (expat only)
+    returns:
+      the list of what each ff returns on ET.parse(source)
+    """
+    if not streamable(ffs):
+        raise ValueError("Some extractors need the whole tree: %s" % ", ".join(
+            ff.__name__ for ff in ffs if not streamable([ff])))
+    if max_bytes is not None and backend != "expat":
+        raise ValueError("Only the expat backend can parse part of a trace")
+    stream = TraceStream(ffs)
+    if backend == "expat":
+        if isinstance(source, basestring):
+            with open(source, "rb") as f:
+                _stream_expat(stream, f, max_bytes)
+        else:
+            _stream_expat(stream, source, max_bytes)
+    elif backend == "lxml":
+        _stream_lxml(stream, source)
+    else:
+        raise ValueError("Unknown parser backend: %s" % backend)
+    return stream.results()
+
+def stream_feats(ffs, source, backend="expat", max_bytes=None):
+    """
+    returns the trace's feature dict, the same as the union of
+    ff(ET.parse(source)) over ffs (see stream_results)
+    """
+    rowfd = {}
+    [rowfd.update(c) for c in stream_results(ffs, source, backend, max_bytes)]
+    return rowfd
@@ -0,0 +1,305 @@
+## Incremental updates
+## -------------------
+## New labeled traces used to mean starting over: extract everything, build a
+## new vocabulary, refit. IncrementalModel and the commands below instead
+## keep the raw training matrix, its vocabulary and a manifest of the traces
+## already in it in a state directory, and on update
+##
+##   1. extract only the traces the manifest doesn't list yet
+##   2. number their features by the stored vocabulary (shards.extend_vocabulary
+##      and remap_columns): features we already know keep their columns, new
+##      ones get columns on the right, and the new rows are written as one
+##      more block of the matrix next to the others (see StoredRows), so
+##      nothing already stored is read or rewritten
+##   3. update the FeatureTransform's column statistics with the new rows
+##   4. refit the logistic regression starting from its previous weights
+##      (zero for the new columns and classes)
+##   5. add trees_per_update trees to the forest (warm_start)
+##
+## Steps 4 and 5 train on the new rows plus a random replay sample of about
+## as many old rows (with every known class in it), and only those rows are
+## read from the memory-mapped blocks, so an update costs time, I/O and memory
+## in proportion to the new data and the models don't forget the old. The
+## forest sees raw counts, which don't shift as the transform is updated, and
+## only the columns it was first fitted on, since every tree has to take the
+## same columns: features first seen in new traces only reach the logistic
+## regression. Once those are more than refit_growth of the forest's columns,
+## or a class it has never seen turns up, the forest is refitted on every row
+## (and so on the whole vocabulary) instead, which does read every row.
+## Every update says which it did.
+##
+##   python incremental.py fit train [state_dir]
+##   python incremental.py update train [state_dir]
+##   python incremental.py predict test [state_dir] [predictions.csv]
+
+import os
+import pickle
+import shutil
+import sys
+import numpy as np
+from scipy import sparse
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+import manifest
+import profiling
+import shards as shards_mod
+import shared
+import transforms
+import util
+
+def replay_rows(t, num_rows, random_state=0):
+    """
+    A random sample of about num_rows of the rows of t, sorted, with at least
+    one row of every class in t
+    """
+    t = np.asarray(t)
+    rng = np.random.RandomState(random_state)
+    num_rows = min(len(t), num_rows)
+    sample = rng.choice(len(t), num_rows, replace=False) if num_rows else np.array([], dtype=int)
+    one_each = [rng.choice(np.flatnonzero(t == clazz)) for clazz in np.unique(t)]
+    return np.union1d(sample, np.array(one_each, dtype=int))
+
+class StoredRows(object):
+    """
+    The training matrix of a state directory: one memory-mapped CSR block
+    (a shared.SharedMatrix) per fit or update, in row order. Blocks written
+    before the vocabulary grew are narrower; they read as if padded with
+    empty columns. X[rows] reads just the given rows, in ascending order, and
+    so only touches their pages of the files.
+    """
+    def __init__(self, blocks, num_cols):
+        self.blocks = blocks
+        self.starts = np.cumsum([0] + [block.shape[0] for block in blocks])
+        self.shape = (int(self.starts[-1]), num_cols)
+
+    def __getitem__(self, rows):
+        rows = np.sort(np.asarray(rows, dtype=int))
+        which = np.searchsorted(self.starts, rows, side="right") - 1
+        parts = [sparse.csr_matrix((0, self.shape[1]))]
+        for b in np.unique(which):
+            local = rows[which == b] - self.starts[b]
+            parts.append(shards_mod.widen(self.blocks[b].load()[local], self.shape[1]))
+        return sparse.vstack(parts).tocsr()
+
+class IncrementalModel(object):
+    """
+    A logistic regression (on transformed features) and a forest (on raw
+    counts) whose probabilities are averaged, and which can be updated with
+    new rows without being refitted on all of them.
+
+    arguments:
+      regularization is the logistic regression's C
+      num_trees is the size of the forest at the first fit
+      trees_per_update is how many trees each update adds
+      replay is the number of old rows trained on in an update, as a
+        multiple of the number of new rows
+      max_iter bounds the logistic regression's iterations per fit
+      refit_growth is how many columns the forest may be missing, as a
+        fraction of the columns it has, before it is refitted from scratch
+    """
+    def __init__(self, regularization=0.001, num_trees=100, trees_per_update=20,
+                 replay=1.0, max_iter=100, refit_growth=0.1, random_state=0):
+        self.regularization = regularization
+        self.num_trees = num_trees
+        self.trees_per_update = trees_per_update
+        self.replay = replay
+        self.max_iter = max_iter
+        self.refit_growth = refit_growth
+        self.random_state = random_state
+        self.updates = 0
+
+    def _fit_forest(self, X, t):
+        self.forest = RandomForestClassifier(n_estimators=self.num_trees, warm_start=True,
+                                             random_state=self.random_state)
+        self.forest_width = X.shape[1]
+        self.forest.fit(X, t)
+
+    def fit(self, X, t):
+        """
+        Fits everything from scratch on the raw matrix X
+        """
+        self.transform = transforms.FeatureTransform().fit(X)
+        self.logistic = LogisticRegression(C=self.regularization, solver="lbfgs",
+                                           multi_class="multinomial", warm_start=True,
+                                           max_iter=self.max_iter)
+        with profiling.stage("fit_logistic"):
+            self.logistic.fit(self.transform.transform(X), t)
+        with profiling.stage("fit_forest"):
+            self._fit_forest(X, t)
+        return self
+
+    def _warm_start_logistic(self, num_features, classes):
+        """
+        Lays the previous weights out for the given classes and (possibly
+        more) columns, zero where there weren't any
+        """
+        old = self.logistic
+        coef = np.zeros((len(classes), num_features))
+        intercept = np.zeros(len(classes))
+        for row, clazz in enumerate(classes):
+            match = np.flatnonzero(old.classes_ == clazz)
+            if len(match):
+                coef[row, :old.coef_.shape[1]] = old.coef_[match[0]]
+                intercept[row] = old.intercept_[match[0]]
+        old.coef_ = coef
+        old.intercept_ = intercept
+
+    def update(self, X, t, num_new):
+        """
+        arguments:
+          X, t are every training row and target, the last num_new of them
+            new; X may have more columns than before (new ones on the right).
+            X is a sparse matrix or StoredRows: only X[rows] and X.shape are
+            used, and all the rows are only taken when the forest is refitted.
+        """
+        t = np.asarray(t)
+        num_old = X.shape[0] - num_new
+        new = np.arange(num_old, X.shape[0])
+        self.updates += 1
+        with profiling.stage("update_transform"):
+            self.transform.partial_fit(X[new])
+        rows = np.union1d(replay_rows(t[:num_old], int(self.replay * num_new),
+                                      self.random_state + self.updates), new)
+        X_rows, t_rows = X[rows], t[rows]
+        with profiling.stage("fit_logistic"):
+            self._warm_start_logistic(X.shape[1], np.unique(t_rows))
+            self.logistic.fit(self.transform.transform(X_rows), t_rows)
+        unseen = X.shape[1] - self.forest_width
+        with profiling.stage("fit_forest"):
+            if not np.array_equal(np.unique(t_rows), self.forest.classes_):
+                # trees can't vote for a class they never saw
+                print "New classes; refitting the forest on every row"
+                self._fit_forest(X[np.arange(X.shape[0])], t)
+            elif unseen > self.refit_growth * self.forest_width:
+                print "The forest is missing %d new columns; refitting it on every row" % unseen
+                self._fit_forest(X[np.arange(X.shape[0])], t)
+            else:
+                self.forest.n_estimators += self.trees_per_update
+                self.forest.fit(X_rows[:, :self.forest_width], t_rows)
+                print ("Added %d trees; %d of %d columns are newer than the forest and "
+                       "only reach the logistic regression" % (self.trees_per_update, unseen,
+                                                               X.shape[1]))
+        return self
+
+    def predict_proba(self, X):
+        """
+        X must have the columns of the last fit or update
+        """
+        logistic = util.full_probas(self.logistic,
+                                    self.logistic.predict_proba(self.transform.transform(X)))
+        forest = util.full_probas(self.forest,
+                                  self.forest.predict_proba(X[:, :self.forest_width]))
+        return (logistic + forest) / 2.0
+
+    def predict(self, X):
+        return np.argmax(self.predict_proba(X), axis=1)
+
+def _load(state_dir, name):
+    with open(os.path.join(state_dir, name), "r") as f:
+        return pickle.load(f)
+
+def _save(state_dir, name, value):
+    with open(os.path.join(state_dir, name), "w") as out:
+        pickle.dump(value, out)
+
+def _append_block(state_dir, X):
+    """
+    Writes the rows of X as the state's next matrix block
+    """
+    path = os.path.join(state_dir, "blocks")
+    blocks = _load(state_dir, "blocks") if os.path.exists(path) else []
+    name = "block%05d" % len(blocks)
+    os.makedirs(os.path.join(state_dir, name))
+    shared.SharedMatrix.create(X, directory=os.path.join(state_dir, name))
+    blocks.append((name, X.shape))
+    _save(state_dir, "blocks", blocks)
+
+def stored_rows(state_dir):
+    """
+    The state's training matrix as StoredRows, without reading any of it
+    """
+    num_cols = len(_load(state_dir, "vocabulary"))
+    return StoredRows([shared.SharedMatrix(os.path.join(state_dir, name), "csr", shape)
+                       for name, shape in _load(state_dir, "blocks")], num_cols)
+
+def fit_state(ffs, direc, state_dir, model=None):
+    """
+    Extracts every trace in direc, fits model (by default an
+    IncrementalModel()) on them and saves it, the raw training matrix and
+    the manifest to state_dir
+    """
+    from classifier import extract_feats
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    files = sorted(os.listdir(direc))
+    with profiling.stage("extract"):
+        X, feat_dict, t, ids = extract_feats(ffs, direc, files=files)
+    model = (model or IncrementalModel()).fit(X, t)
+    # start the matrix over, dropping the blocks of any earlier fit
+    if os.path.exists(os.path.join(state_dir, "blocks")):
+        for name, _ in _load(state_dir, "blocks"):
+            shutil.rmtree(os.path.join(state_dir, name), ignore_errors=True)
+        os.remove(os.path.join(state_dir, "blocks"))
+    _append_block(state_dir, X)
+    _save(state_dir, "vocabulary", feat_dict)
+    _save(state_dir, "targets", (t, ids))
+    _save(state_dir, "incremental_model", model)
+    manifest.write_manifest(manifest.build_manifest(direc, hash_files=False, files=files),
+                            os.path.join(state_dir, "train_manifest.csv"))
+    return model
+
+def update_state(ffs, direc, state_dir):
+    """
+    Extracts the traces in direc the state's manifest doesn't list, appends
+    them as a new block and updates the model, reading only the old rows it
+    replays. returns the number of new traces.
+    """
+    from classifier import extract_feats
+    entries = manifest.read_manifest(os.path.join(state_dir, "train_manifest.csv"))
+    known = set(entry["filename"] for entry in entries)
+    new_files = sorted(set(os.listdir(direc)).difference(known))
+    if not new_files:
+        return 0
+    with profiling.stage("extract"):
+        X_new, new_feat_dict, t_new, ids_new = extract_feats(ffs, direc, files=new_files)
+    with profiling.stage("append"):
+        feat_dict = shards_mod.extend_vocabulary(_load(state_dir, "vocabulary"), new_feat_dict)
+        _append_block(state_dir, shards_mod.remap_columns(X_new, new_feat_dict, feat_dict))
+        _save(state_dir, "vocabulary", feat_dict)
+        t, ids = _load(state_dir, "targets")
+        t = np.concatenate([t, t_new])
+        _save(state_dir, "targets", (t, list(ids) + list(ids_new)))
+    model = _load(state_dir, "incremental_model").update(stored_rows(state_dir), t,
+                                                          len(new_files))
+    _save(state_dir, "incremental_model", model)
+    entries += manifest.build_manifest(direc, hash_files=False, files=new_files)
+    manifest.write_manifest(sorted(entries, key=lambda entry: entry["filename"]),
+                            os.path.join(state_dir, "train_manifest.csv"))
+    return len(new_files)
+
+def predict_state(ffs, direc, state_dir, outputfile):
+    from classifier import extract_feats
+    X, _, _, ids = extract_feats(ffs, direc, global_feat_dict=_load(state_dir, "vocabulary"))
+    util.write_predictions(_load(state_dir, "incremental_model").predict(X), ids, outputfile)
+
+def main(argv):
+    from extractors import ffs
+    if len(argv) < 3 or argv[1] not in ("fit", "update", "predict"):
+        print "usage: python incremental.py fit|update|predict direc [state_dir] [predictions.csv]"
+        return 2
+    command, direc = argv[1:3]
+    state_dir = argv[3] if len(argv) > 3 else "incremental"
+    if command == "fit":
+        fit_state(ffs, direc, state_dir)
+        print "Fitted on %s" % direc
+    elif command == "update":
+        num_new = update_state(ffs, direc, state_dir)
+        print "Updated with %d new traces" % num_new if num_new else "No new traces"
+    else:
+        outputfile = argv[4] if len(argv) > 4 else "incrementalpredictions.csv"
+        predict_state(ffs, direc, state_dir, outputfile)
+        print "Wrote %s" % outputfile
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
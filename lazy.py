@@ -0,0 +1,118 @@
+## Lazy, cheap-first extraction
+## ----------------------------
+## Extracting every feature of every test trace costs a full parse and every
+## extractor, even for traces a few counts would settle. LazyCascade extracts
+## in tiers instead (see @tier in extractors.py):
+##
+##   1. the tier 1 extractors run on a partial parse of only the first
+##      max_bytes of each trace, and a cheap calibrated model trained on the
+##      same partial features predicts from them
+##   2. only the traces the cheap model isn't sure about (top probability
+##      below threshold) get the full extraction and the expensive model
+##
+## The cheap model is trained on partial features of the training traces, so
+## it sees the same kind of (truncated) counts at training and prediction time.
+
+import os
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from calibration import CalibratedModel
+from extractors import tier_of
+import fastparse
+import profiling
+import util
+
+def tier_ffs(ffs, max_tier=1):
+    """
+    The extractors of ffs with a tier of at most max_tier
+    """
+    return [ff for ff in ffs if tier_of(ff) <= max_tier]
+
+def extract_partial(ffs, direc, files=None, global_feat_dict=None,
+                    max_bytes=1 << 20):
+    """
+    Like classifier.extract_feats, but only streams the first max_bytes of
+    each trace through expat (ffs must all be streamable). returns the same
+    (X, feat_dict, t, ids).
+    """
+    from classifier import make_design_mat
+    directory = sorted(os.listdir(direc) if files is None else files)
+    fds = []
+    classes = []
+    ids = []
+    for datafile in directory:
+        id_str, clazz = datafile.split('.')[:2]
+        ids.append(id_str)
+        classes.append(-1 if clazz == "X" else util.malware_classes.index(clazz))
+        with profiling.stage("partial"):
+            fds.append(fastparse.stream_feats(ffs, os.path.join(direc, datafile),
+                                              "expat", max_bytes))
+    X, feat_dict = make_design_mat(fds, global_feat_dict)
+    return X, feat_dict, np.array(classes), ids
+
+class LazyCascade(object):
+    """
+    arguments:
+      expensive is a fitted classifier over the full features
+      feat_dict is the vocabulary expensive was trained with
+      ffs are all the feature-functions expensive's features came from
+      cheap is the classifier for the tier 1 features; defaults to a
+        temperature-calibrated logistic regression
+      max_tier is the highest tier the cheap model uses
+      max_bytes is how much of each trace the cheap features are taken from
+      threshold is the top probability above which the cheap answer is kept
+      prepare is applied to the full feature matrix before expensive sees it
+        (say a FeatureTransform's transform)
+      parser is the parser used for the full extraction (see extract_feats)
+    """
+    def __init__(self, expensive, feat_dict, ffs, cheap=None, max_tier=1,
+                 max_bytes=1 << 20, threshold=0.9, prepare=None, parser="etree"):
+        self.expensive = expensive
+        self.feat_dict = feat_dict
+        self.ffs = ffs
+        self.cheap_ffs = tier_ffs(ffs, max_tier)
+        if not self.cheap_ffs or not fastparse.streamable(self.cheap_ffs):
+            raise ValueError("The tier %d extractors can't be streamed" % max_tier)
+        if cheap is None:
+            cheap = CalibratedModel(LogisticRegression(C=0.01), method="temperature")
+        self.cheap = cheap
+        self.max_bytes = max_bytes
+        self.threshold = threshold
+        self.prepare = prepare
+        self.parser = parser
+
+    def fit(self, direc, files=None):
+        """
+        Fits the cheap model on the partial features of the training traces
+        in direc (the expensive model is already fitted)
+        """
+        X, self.cheap_feat_dict, t, _ = extract_partial(
+            self.cheap_ffs, direc, files, max_bytes=self.max_bytes)
+        self.cheap.fit(X, t)
+        return self
+
+    def predict_proba(self, direc, files=None):
+        """
+        returns the class probabilities of the traces in direc (in sorted
+        file name order) and their ids
+        """
+        from classifier import extract_feats
+        directory = sorted(os.listdir(direc) if files is None else files)
+        X_cheap, _, _, ids = extract_partial(self.cheap_ffs, direc, directory,
+                                             self.cheap_feat_dict, self.max_bytes)
+        probas = util.full_probas(self.cheap, self.cheap.predict_proba(X_cheap))
+        unsure = np.flatnonzero(probas.max(axis=1) < self.threshold)
+        if len(unsure):
+            X, _, _, _ = extract_feats(self.ffs, direc, global_feat_dict=self.feat_dict,
+                                       files=[directory[i] for i in unsure],
+                                       parser=self.parser)
+            if self.prepare is not None:
+                X = self.prepare(X)
+            probas[unsure] = util.full_probas(self.expensive, self.expensive.predict_proba(X))
+        # the share of traces the cheap features settled, for reporting
+        self.exit_rate_ = 1.0 - len(unsure) / float(max(1, len(directory)))
+        return probas, ids
+
+    def predict(self, direc, files=None):
+        probas, ids = self.predict_proba(direc, files)
+        return np.argmax(probas, axis=1), ids
@@ -0,0 +1,222 @@
+## Manifests and shards
+## --------------------
+## A manifest lists every trace in a data directory (id, class, size and a
+## sha1 of its contents) sorted by file name, so every machine agrees on which
+## file is row i. It can be split into shards of roughly equal total size,
+## which can then be extracted on different machines and merged back into one
+## design matrix with the rows in manifest order.
+##
+## From the command line:
+##   python manifest.py build train train_manifest.csv
+##   python manifest.py extract train_manifest.csv train 4 0 train_shard0
+##   python manifest.py merge merged_dir train_shard0 train_shard1 ...
+## which writes the merged X_train/global_feat_dict/t_train/train_ids pickles
+## into merged_dir, ready for "python classifier.py load" to be run there.
+## Shards of new training files can later be added on to those with
+##   python manifest.py append merged_dir new_shard0 ...
+##
+## extract checks every trace against the sha1 in the manifest before reading
+## it, and writes the entries it extracted next to the shard (shard.csv).
+## merge keeps their union in merged_dir/manifest.csv, and append refuses any
+## trace already listed there: a re-extracted trace would be a duplicate row,
+## and one whose contents changed under the same name has to be rebuilt, not
+## appended.
+
+import csv
+import hashlib
+import heapq
+import os
+import pickle
+import sys
+import numpy as np
+import shards as shards_mod
+import util
+
+FIELDS = ["id", "clazz", "size", "sha1", "filename"]
+
+def file_sha1(path, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def build_manifest(direc, hash_files=True, files=None):
+    """
+    Scans direc once and returns a list of dicts with the FIELDS of each
+    trace (or just of those in files), sorted by file name
+    """
+    entries = []
+    for datafile in sorted(os.listdir(direc) if files is None else files):
+        path = os.path.join(direc, datafile)
+        id_str, clazz = datafile.split('.')[:2]
+        entries.append({
+            "id": id_str,
+            "clazz": clazz,
+            "size": os.path.getsize(path),
+            "sha1": file_sha1(path) if hash_files else "",
+            "filename": datafile,
+        })
+    return entries
+
+def write_manifest(entries, path):
+    with open(path, "w") as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writerow(dict(zip(FIELDS, FIELDS)))
+        for entry in entries:
+            writer.writerow(entry)
+
+def read_manifest(path):
+    with open(path, "r") as f:
+        entries = list(csv.DictReader(f))
+    for entry in entries:
+        entry["size"] = int(entry["size"])
+    return entries
+
+def check_manifest(entries, direc):
+    """
+    Raises ValueError if any trace in direc no longer has the sha1 recorded in
+    its manifest entry (entries built without hashes aren't checked)
+    """
+    changed = [entry["filename"] for entry in entries if entry["sha1"] and
+               file_sha1(os.path.join(direc, entry["filename"])) != entry["sha1"]]
+    if changed:
+        raise ValueError("%d traces changed since the manifest was built: %s"
+                         % (len(changed), ", ".join(changed)))
+
+def combine_manifests(listed, new_entries):
+    """
+    arguments:
+      listed is the manifest of the rows merged so far, new_entries that of
+      the rows to add
+    returns:
+      both combined, sorted by file name; raises ValueError if a trace of
+      new_entries is listed already (or twice in new_entries)
+    """
+    known = dict((entry["id"], entry) for entry in listed)
+    changed, repeated = [], []
+    for entry in new_entries:
+        old = known.get(entry["id"])
+        if old is None:
+            known[entry["id"]] = entry
+        elif old["sha1"] != entry["sha1"]:
+            changed.append(entry["filename"])
+        else:
+            repeated.append(entry["filename"])
+    if changed:
+        raise ValueError("%d traces changed since they were merged, rebuild the merged "
+                         "features instead: %s" % (len(changed), ", ".join(changed)))
+    if repeated:
+        raise ValueError("%d traces are already merged: %s"
+                         % (len(repeated), ", ".join(repeated)))
+    return sorted(known.values(), key=lambda entry: entry["filename"])
+
+def target(entry):
+    """
+    The class index of a manifest entry, or -1 for test data
+    """
+    if entry["clazz"] == "X":
+        return -1
+    return util.malware_classes.index(entry["clazz"])
+
+def shard_manifest(entries, num_shards):
+    """
+    Splits entries into num_shards lists with roughly equal total file size:
+    biggest files first, each to the shard with the least bytes so far. Each
+    shard keeps manifest order.
+    """
+    heap = [(0, shard) for shard in xrange(num_shards)]
+    assignment = [[] for _ in xrange(num_shards)]
+    by_size = sorted(xrange(len(entries)), key=lambda i: -entries[i]["size"])
+    for i in by_size:
+        total, shard = heapq.heappop(heap)
+        assignment[shard].append(i)
+        heapq.heappush(heap, (total + entries[i]["size"], shard))
+    return [[entries[i] for i in sorted(rows)] for rows in assignment]
+
+def extract_shard(ffs, entries, direc, out_path):
+    """
+    Checks the traces of one shard against their sha1s, extracts them with
+    their own local vocabulary and pickles (X, feat_dict, t, ids) to
+    out_path, with the shard's manifest entries in out_path.csv
+    """
+    from classifier import extract_feats
+    check_manifest(entries, direc)
+    files = [entry["filename"] for entry in entries]
+    X, feat_dict, t, ids = extract_feats(ffs, direc, files=files)
+    with open(out_path, "w") as out:
+        pickle.dump((X, feat_dict, t, ids), out)
+    write_manifest(entries, out_path + ".csv")
+    return X, feat_dict, t, ids
+
+def merge_shards(shards):
+    """
+    arguments:
+      shards is a list of (X, feat_dict, t, ids) with local vocabularies
+    returns:
+      (X, feat_dict, t, ids) over the union of the vocabularies, with the
+      rows sorted by id (manifest order)
+    """
+    X, global_feat_dict = shards_mod.merge_design_mats(
+        [(X, feat_dict) for X, feat_dict, _, _ in shards])
+    t = np.concatenate([shard[2] for shard in shards])
+    ids = [id_str for shard in shards for id_str in shard[3]]
+    order = np.argsort(ids, kind="mergesort")
+    return X[order], global_feat_dict, t[order], [ids[i] for i in order]
+
+def append_shards(merged, shards):
+    """
+    Appends the rows of new shards after those of an already merged
+    (X, feat_dict, t, ids), without touching the existing rows or columns
+    """
+    X, feat_dict, t, ids = merged
+    for X_new, new_feat_dict, t_new, ids_new in shards:
+        X, feat_dict = shards_mod.append_design_mat(X, feat_dict, X_new, new_feat_dict)
+        t = np.concatenate([t, t_new])
+        ids = list(ids) + list(ids_new)
+    return X, feat_dict, t, ids
+
+def main(argv):
+    command = argv[1]
+    if command == "build":
+        direc, path = argv[2:4]
+        write_manifest(build_manifest(direc), path)
+    elif command == "extract":
+        from extractors import ffs
+        path, direc, num_shards, shard, out_path = argv[2:7]
+        shards = shard_manifest(read_manifest(path), int(num_shards))
+        extract_shard(ffs, shards[int(shard)], direc, out_path)
+    elif command in ("merge", "append"):
+        from classifier import save_train_features
+        out_dir, shard_paths = argv[2], argv[3:]
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        merged_manifest = os.path.join(out_dir, "manifest.csv")
+        listed = read_manifest(merged_manifest) if command == "append" else []
+        shards, new_entries = [], []
+        for shard_path in shard_paths:
+            with open(shard_path, "r") as f:
+                shards.append(pickle.load(f))
+            entries = read_manifest(shard_path + ".csv")
+            if [entry["id"] for entry in entries] != list(shards[-1][3]):
+                raise ValueError("%s doesn't match its manifest %s.csv"
+                                 % (shard_path, shard_path))
+            new_entries += entries
+        # raises before anything in out_dir is touched
+        entries = combine_manifests(listed, new_entries)
+        if command == "merge":
+            merged = merge_shards(shards)
+        else:
+            with open(os.path.join(out_dir, "raw_train"), "r") as f:
+                merged = append_shards(pickle.load(f), shards)
+        # keep the full merged matrix around for later appends; classifier
+        # loads the same raw features and selects columns itself
+        with open(os.path.join(out_dir, "raw_train"), "w") as out:
+            pickle.dump(merged, out)
+        write_manifest(entries, merged_manifest)
+        save_train_features(*merged, direc=out_dir)
+    else:
+        print "usage: python manifest.py build|extract|merge|append ..."
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,443 @@
+## Profiling
+## ---------
+## The pipeline is split into named stages (listing the data directory,
+## parsing, extracting, building the design matrix, fitting, predicting,
+## writing). Code marks its stages with
+##
+##     with profiling.stage("parse"):
+##         tree = ET.parse(...)
+##
+## which does nothing unless a profiler has been started with
+## profiling.start(). When one is running, every stage records its wall time,
+## how many times it ran, the peak RSS while it ran and, unless turned off,
+## what its first run allocated: the top allocation sites from tracemalloc
+## where there is one (python 3, or pytracemalloc), otherwise the object types
+## whose count of gc-tracked objects grew the most. The report's "allocators"
+## says which it was; gc only sees containers (lists, dicts, class instances),
+## not strings, numbers or numpy buffers.
+## profiling.stop(path) writes all of it out as json, so runs can be diffed
+## against each other to catch memory regressions.
+##
+## The profiler can also find out where the CPU time goes:
+##   cpu="cprofile" - every stage gets its own cProfile.Profile, written out
+##                    as <cpu_path>-<stage>.pstats
+##   cpu="sample"   - a SIGPROF timer samples the python stack every interval
+##                    seconds, and the stacks (rooted at the stage they were
+##                    taken in) are written to <cpu_path>.collapsed in the
+##                    collapsed-stack format flamegraph.pl and speedscope load
+## Worker processes started through profiling.make_pool() profile themselves
+## with the same settings and dump their results when they exit, and
+## merge_workers() folds those back into the main profiler.
+
+import cProfile
+import contextlib
+import gc
+import glob
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import platform
+import pstats
+import resource
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from collections import Counter
+try:
+    import tracemalloc
+except ImportError:
+    # python 2 only has it as the third-party pytracemalloc
+    tracemalloc = None
+
+PROC_STATUS = "/proc/self/status"
+PROC_CLEAR_REFS = "/proc/self/clear_refs"
+
+def gc_type_counts():
+    """
+    The number of gc-tracked objects of each type name
+    """
+    return Counter(type(obj).__name__ for obj in gc.get_objects())
+
+def read_rss():
+    """
+    returns (current rss, peak rss since the last reset) of this process in
+    KB. Without /proc both are the lifetime peak from getrusage.
+    """
+    try:
+        with open(PROC_STATUS) as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return (int(fields["VmRSS"].split()[0]), int(fields["VmHWM"].split()[0]))
+    except (IOError, OSError, KeyError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak //= 1024   # bytes there, KB on linux
+        return peak, peak
+
+def reset_peak_rss():
+    """
+    Resets the kernel's peak rss counter (VmHWM), returning whether that is
+    possible here
+    """
+    try:
+        with open(PROC_CLEAR_REFS, "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+class StackSampler(object):
+    """
+    Samples the python stack of the main thread every interval seconds of CPU
+    time, counting each distinct stack. stage_of() names the stage the sample
+    was taken in, which becomes the root frame of its stack.
+    """
+    def __init__(self, interval=0.005, stage_of=lambda: None):
+        self.interval = interval
+        self.stage_of = stage_of
+        self.stacks = Counter()
+        self._old_handler = None
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append("%s (%s:%d)" % (code.co_name,
+                os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        names.append(self.stage_of() or "(no stage)")
+        names.reverse()
+        self.stacks[";".join(names)] += 1
+
+    def start(self):
+        self._old_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._old_handler or signal.SIG_DFL)
+
+    def write_collapsed(self, path):
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.iteritems()):
+                f.write("%s %d\n" % (stack, count))
+
+    def read_collapsed(self, path):
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if stack:
+                    self.stacks[stack] += int(count)
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.peak_rss_kb = 0
+        self.rss_growth_kb = 0
+        self.top_allocators = None
+        self.cprofile = None
+
+    def to_dict(self):
+        out = {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "peak_rss_kb": self.peak_rss_kb,
+            "rss_growth_kb": self.rss_growth_kb,
+        }
+        if self.top_allocators is not None:
+            out["top_allocators"] = self.top_allocators
+        return out
+
+class Profiler(object):
+    """
+    Collects per-stage statistics. Stages can nest; an outer stage's peak
+    covers everything that ran inside it.
+
+    arguments:
+      trace_frames is how many frames tracemalloc keeps per allocation; 0
+        turns allocation tracking off
+      top is how many allocation sites (or object types) are reported per
+        stage
+      cpu is None, "cprofile" or "sample" (see the top of this file)
+      interval is the sampling interval in seconds for cpu="sample"
+    """
+    def __init__(self, trace_frames=1, top=10, cpu=None, interval=0.005):
+        if cpu not in (None, "cprofile", "sample"):
+            raise ValueError("Unknown cpu profiler: %s" % cpu)
+        self.settings = {"trace_frames": trace_frames, "top": top,
+                         "cpu": cpu, "interval": interval}
+        self.stages = {}
+        self.order = []
+        self.top = top
+        self.cpu = cpu
+        self.started = time.time()
+        self._open = []     # [stats, peak seen so far] of the running stages
+        self.worker_reports = []
+        self.worker_pstats = {}     # stage -> pstats.Stats dumped by workers
+        self.worker_dir = None
+        self.can_reset = reset_peak_rss()
+        if not trace_frames:
+            self.allocations = None
+        elif tracemalloc is not None:
+            self.allocations = "tracemalloc"
+        else:
+            self.allocations = "gc"
+        self.tracing = self.allocations == "tracemalloc"
+        if self.tracing and not tracemalloc.is_tracing():
+            tracemalloc.start(trace_frames)
+        self.sampler = None
+        if cpu == "sample":
+            self.sampler = StackSampler(interval, self._current_stage)
+            self.sampler.start()
+
+    def _current_stage(self):
+        if self._open:
+            return self._open[-1][0].name
+        return None
+
+    def _stats(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageStats(name)
+            self.order.append(name)
+        return self.stages[name]
+
+    def _fold_peak(self):
+        """
+        Credits the peak rss since the last reset to every running stage,
+        before anyone resets it again
+        """
+        _, peak = read_rss()
+        for frame in self._open:
+            frame[1] = max(frame[1], peak)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stats = self._stats(name)
+        snapshot = None
+        if self.allocations is not None and stats.top_allocators is None:
+            snapshot = self._snapshot()
+        self._fold_peak()
+        if self.can_reset:
+            reset_peak_rss()
+        rss_before, peak = read_rss()
+        frame = [stats, peak]
+        if self.cpu == "cprofile":
+            # only one profiler can be hooked in at a time, so the enclosing
+            # stage's is paused while this one runs
+            if self._open:
+                self._open[-1][0].cprofile.disable()
+            if stats.cprofile is None:
+                stats.cprofile = cProfile.Profile()
+            stats.cprofile.enable()
+        self._open.append(frame)
+        start = time.time()
+        try:
+            yield stats
+        finally:
+            stats.seconds += time.time() - start
+            stats.calls += 1
+            self._fold_peak()
+            self._open.pop()
+            if self.cpu == "cprofile":
+                stats.cprofile.disable()
+                if self._open:
+                    self._open[-1][0].cprofile.enable()
+            rss_after, _ = read_rss()
+            stats.peak_rss_kb = max(stats.peak_rss_kb, frame[1])
+            stats.rss_growth_kb = max(stats.rss_growth_kb, frame[1] - rss_before)
+            if snapshot is not None:
+                stats.top_allocators = self._top_allocators(snapshot)
+            # the stage that ran inside the outer ones counts towards them too
+            for outer in self._open:
+                outer[1] = max(outer[1], frame[1])
+
+    def _snapshot(self):
+        if self.tracing:
+            return tracemalloc.take_snapshot()
+        return gc_type_counts()
+
+    def _top_allocators(self, before):
+        if not self.tracing:
+            grown = gc_type_counts()
+            grown.subtract(before)
+            return [{"where": "type:%s" % name, "count": count}
+                    for name, count in grown.most_common(self.top) if count > 0]
+        after = tracemalloc.take_snapshot()
+        diffs = after.compare_to(before, "lineno")[:self.top]
+        return [{
+            "where": "%s:%d" % (diff.traceback[0].filename, diff.traceback[0].lineno),
+            "size_kb": diff.size_diff / 1024.0,
+            "count": diff.count_diff,
+        } for diff in diffs]
+
+    def report(self):
+        _, peak = read_rss()
+        return {
+            "started": self.started,
+            "seconds": time.time() - self.started,
+            "python": platform.python_version(),
+            "peak_rss_is_per_stage": self.can_reset,
+            "allocators": self.allocations,
+            "final_peak_rss_kb": max([peak] + [s.peak_rss_kb for s in self.stages.values()]),
+            "stage_order": list(self.order),
+            "stages": dict((name, s.to_dict()) for name, s in self.stages.items()),
+            "workers": self.worker_reports,
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def stop_cpu(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def write_cpu(self, cpu_path):
+        """
+        Writes the cpu profile: <cpu_path>.collapsed for cpu="sample", or one
+        <cpu_path>-<stage>.pstats per stage for cpu="cprofile", merged with
+        whatever the workers profiled in the same stage
+        """
+        if self.cpu == "sample":
+            self.sampler.write_collapsed(cpu_path + ".collapsed")
+        elif self.cpu == "cprofile":
+            stages = set(name for name in self.order
+                         if self.stages[name].cprofile is not None)
+            stages.update(self.worker_pstats)
+            for name in stages:
+                parts = list(self.worker_pstats.get(name, []))
+                if name in self.stages and self.stages[name].cprofile is not None:
+                    parts.insert(0, pstats.Stats(self.stages[name].cprofile))
+                stats = parts[0]
+                for part in parts[1:]:
+                    stats.add(part)
+                stats.dump_stats("%s-%s.pstats" % (cpu_path, name))
+
+    def dump_worker(self, directory):
+        """
+        Writes everything this (worker) profiler collected into directory,
+        for the main process's merge_workers to pick up
+        """
+        self.stop_cpu()
+        prefix = os.path.join(directory, "worker-%d" % os.getpid())
+        with open(prefix + ".json", "w") as f:
+            json.dump(self.report(), f)
+        if self.sampler is not None:
+            self.sampler.write_collapsed(prefix + ".collapsed")
+        for name in self.order:
+            if self.stages[name].cprofile is not None:
+                self.stages[name].cprofile.dump_stats("%s.%s.pstats" % (prefix, name))
+
+    def merge_workers(self):
+        """
+        Folds in everything dumped by workers that have exited since the last
+        call
+        """
+        if self.worker_dir is None:
+            return
+        for path in sorted(glob.glob(os.path.join(self.worker_dir, "worker-*.json"))):
+            prefix = path[:-len(".json")]
+            with open(path) as f:
+                report = json.load(f)
+            report["pid"] = int(os.path.basename(prefix).split("-")[1])
+            self.worker_reports.append(report)
+            if self.sampler is not None and os.path.exists(prefix + ".collapsed"):
+                self.sampler.read_collapsed(prefix + ".collapsed")
+            for name in report["stage_order"]:
+                stats_path = "%s.%s.pstats" % (prefix, name)
+                if os.path.exists(stats_path):
+                    # keep the data, not the file, so the directory can go
+                    self.worker_pstats.setdefault(name, []).append(pstats.Stats(stats_path))
+            for leftover in glob.glob(prefix + ".*"):
+                os.remove(leftover)
+
+    def worker_settings(self):
+        """
+        What a worker process needs to profile itself like we do
+        """
+        if self.worker_dir is None:
+            self.worker_dir = tempfile.mkdtemp(prefix="profile-workers-")
+        return {"settings": self.settings, "dir": self.worker_dir}
+
+    def cleanup(self):
+        self.stop_cpu()
+        if self.worker_dir is not None:
+            shutil.rmtree(self.worker_dir, ignore_errors=True)
+            self.worker_dir = None
+
+    def print_report(self):
+        print "%-16s %6s %10s %12s %12s" % ("stage", "calls", "seconds", "peak MB", "growth MB")
+        for name in self.order:
+            s = self.stages[name]
+            print "%-16s %6d %10.3f %12.1f %12.1f" % (name, s.calls, s.seconds,
+                s.peak_rss_kb / 1024.0, s.rss_growth_kb / 1024.0)
+
+# the running profiler, if any
+current = None
+
+def start(**profiler_args):
+    global current
+    current = Profiler(**profiler_args)
+    return current
+
+def stop(path=None, cpu_path="cpu_profile"):
+    """
+    Stops the running profiler, printing its report and writing it to path
+    as json if one is given, and writing its cpu profile (if it made one)
+    next to cpu_path. returns the report.
+    """
+    global current
+    profiler, current = current, None
+    if profiler is None:
+        return None
+    profiler.stop_cpu()
+    profiler.merge_workers()
+    profiler.print_report()
+    if path is not None:
+        profiler.write(path)
+    profiler.write_cpu(cpu_path)
+    profiler.cleanup()
+    if profiler.tracing:
+        tracemalloc.stop()
+    return profiler.report()
+
+def init_worker(worker_settings):
+    """
+    Pool initializer: starts a profiler in the worker with the main process's
+    settings, which dumps its results when the worker exits
+    """
+    if worker_settings is None:
+        return
+    profiler = start(**worker_settings["settings"])
+    # workers leave through os._exit, so atexit never runs; multiprocessing's
+    # own finalizers do
+    multiprocessing.util.Finalize(None, profiler.dump_worker,
+                                  args=(worker_settings["dir"],), exitpriority=10)
+
+def make_pool(processes=None):
+    """
+    A multiprocessing.Pool whose workers are profiled like this process is,
+    if a profiler is running. Call merge_workers() once the pool is joined.
+    """
+    if current is None:
+        return multiprocessing.Pool(processes)
+    return multiprocessing.Pool(processes, init_worker, (current.worker_settings(),))
+
+def merge_workers():
+    if current is not None:
+        current.merge_workers()
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    Marks a stage of the pipeline; free when no profiler is running
+    """
+    if current is None:
+        yield None
+    else:
+        with current.stage(name) as stats:
+            yield stats
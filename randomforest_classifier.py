@@ -86,10 +86,12 @@ from extractors_old import ffs
 from numpy import matlib, exp
 import matplotlib.pyplot as plt
 import sklearn.linear_model
-from sklearn.decomposition import PCA
 from sklearn.ensemble import RandomForestClassifier
 import pickle
+import reduction
+import sampling
 import util
+import evaluation
 import sys
 
 def extract_feats(ffs, direc="train", global_feat_dict=None):
@@ -113,7 +115,8 @@ def extract_feats(ffs, direc="train", global_feat_dict=None):
     fds = [] # list of feature dicts
     classes = []
     ids = [] 
-    for datafile in os.listdir(direc):
+    # sorted, so the holdout split picks the same files every time
+    for datafile in sorted(os.listdir(direc)):
         # extract id and true class (if available) from filename
         # Keep it clazzy
         id_str,clazz = datafile.split('.')[:2]
@@ -249,29 +252,38 @@ def logistic(features, targets, weights, max_iter = 1000):
 
     pass
 
-def sk_logistic(features, targets, regularization = 0.001):
+def sk_logistic(features, targets, regularization = 0.001, class_weight = None,
+                sample_weight = None):
     """
     Use Scikit Learn 'cause I'm lazy
     First return value is a function that returns a class number based on the input vector
     Second is the actual model objet
+    class_weight and sample_weight are passed on to sklearn (see sampling.py)
     """
 
-    logreg = sklearn.linear_model.LogisticRegression(C=regularization)
-    logreg.fit(features, targets)
+    logreg = sklearn.linear_model.LogisticRegression(C=regularization, class_weight=class_weight)
+    logreg.fit(features, targets, sample_weight=sample_weight)
 
     def predictor(feat):
         return logreg.predict(feat)[0]
     return predictor, logreg
 
-def sk_random_forest(features, targets, num_trees = 10, max_leaves = None):
-    random_forest = RandomForestClassifier(n_estimators = num_trees, max_leaf_nodes = max_leaves)
-    random_forest.fit(features,targets)
+def sk_random_forest(features, targets, num_trees = 10, max_leaves = None,
+                     class_weight = None, sample_weight = None):
+    """
+    class_weight and sample_weight are passed on to sklearn; with
+    class_weight="balanced_subsample" the classes are reweighed within each
+    tree's bootstrap sample (see sampling.py)
+    """
+    random_forest = RandomForestClassifier(n_estimators = num_trees, max_leaf_nodes = max_leaves,
+                                           class_weight = class_weight)
+    random_forest.fit(features, targets, sample_weight = sample_weight)
     def predictor(feat):
         return random_forest.predict(feat)[0]
     return predictor, random_forest
 
 ## The following function does the feature extraction, learning, and prediction
-def main(load = False):
+def main(load = False, balanced = False):
     train_dir = "train"
     test_dir = "test"
     outputfile = "mypredictions.csv"  # feel free to change this or take it as an argument
@@ -314,15 +326,22 @@ def main(load = False):
         print "Done loading"
         print
     
-    #Learn a PCA model, then transform the training and test data
-    #pca = PCA(n_components = 15)
-    #pca.fit(X_train.toarray())
-    #X_train_pca = pca.transform(X_train.toarray())
-    
+    # Learn a sparse reduction (PCA would need X_train.toarray()), then
+    # transform the training and test data
+    print "reducing..."
+    reducer, X_train_reduced = reduction.cached_reduction(X_train, n_components = 100)
+    print "done reducing"
+    print
     
     # TODO train here, and learn your classification parameters
     print "learning..."
-    predictor, random_forest = sk_random_forest(X_train.toarray(), t_train)
+    if balanced:
+        # fewer None rows, and each tree reweighs the classes of its own sample
+        rows = sampling.subsample_majority(t_train)
+        predictor, random_forest = sk_random_forest(X_train_reduced[rows], t_train[rows],
+                                                    class_weight = "balanced_subsample")
+    else:
+        predictor, random_forest = sk_random_forest(X_train_reduced, t_train)
     # Start with logistic regression
     print "done learning"
     print
@@ -337,18 +356,14 @@ def main(load = False):
     #print
     
     # TODO make predictions on text data and write them out
-    #X_holdout_pca = pca.transform(X_holdout.toarray())
-    error = 0
-    total = X_holdout.shape[0]
+    X_holdout_reduced = reducer.transform(X_holdout)
     print "making predictions..."
     #preds = np.argmax(X_test.dot(learned_W),axis=1)
     #preds = logreg.predict(X_test)
-    for index, feats in enumerate(X_holdout.toarray()):
-        prediction = predictor(feats)
-        if (prediction != t_holdout[index]):
-            print "%s: expected %d but got %d" % (holdout_ids[index], t_holdout[index], prediction)
-            error += 1
-    print "Correct: %d, Incorrect: %d, Total: %d, Accuracy: %f" % (total - error, error, total, (total - error) / (1.0 * total))
+    preds, seconds = evaluation.timed_predict(random_forest, X_holdout_reduced)
+    report = evaluation.evaluate(t_holdout, preds, holdout_ids, seconds)
+    evaluation.write_report(report, "evaluation")
+    evaluation.print_summary(report)
     print "done making predictions"
     print
     
@@ -357,5 +372,5 @@ def main(load = False):
     #print "done!"
 
 if __name__ == "__main__":
-    main("load" in sys.argv)
+    main("load" in sys.argv, "balanced" in sys.argv)
     
\ No newline at end of file
@@ -0,0 +1,87 @@
+## Dimensionality reduction
+## ------------------------
+## Our vocabulary has far too many columns to densify (PCA needs X.toarray()),
+## so SparseReducer works on the CSR matrix directly, with either a randomized
+## truncated SVD or a sparse random projection. It is a regular sklearn
+## transformer, so it can sit in front of any classifier in a Pipeline, and
+## cached_reduction() pickles a fitted reducer together with the reduced
+## training matrix so reruns with 'load' don't have to refit it.
+
+import hashlib
+import os
+import pickle
+import numpy as np
+from scipy import sparse
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.decomposition import TruncatedSVD
+from sklearn.pipeline import make_pipeline
+from sklearn.random_projection import SparseRandomProjection
+
+class SparseReducer(BaseEstimator, TransformerMixin):
+    """
+    Reduces a sparse NxD design matrix to a dense N x n_components one.
+    method is "svd" (randomized truncated SVD, which keeps the directions of
+    most variance) or "projection" (a sparse random projection, which is
+    nearly free to fit).
+    """
+    def __init__(self, method="svd", n_components=100, random_state=0):
+        self.method = method
+        self.n_components = n_components
+        self.random_state = random_state
+
+    def fit(self, X, y=None):
+        # can't ask for more components than the matrix has columns
+        k = min(self.n_components, X.shape[1] - 1)
+        if self.method == "svd":
+            self.reducer_ = TruncatedSVD(n_components=k, algorithm="randomized",
+                                         random_state=self.random_state)
+        elif self.method == "projection":
+            self.reducer_ = SparseRandomProjection(n_components=k, dense_output=True,
+                                                   random_state=self.random_state)
+        else:
+            raise ValueError("Unknown reduction method: %s" % self.method)
+        self.reducer_.fit(X)
+        self.n_features_ = X.shape[1]
+        return self
+
+    def transform(self, X):
+        if X.shape[1] != self.n_features_:
+            raise ValueError("Expected %d features but got %d"
+                             % (self.n_features_, X.shape[1]))
+        return self.reducer_.transform(X)
+
+def reduced(classifier, **reducer_args):
+    """
+    Puts a SparseReducer in front of classifier, returning a pipeline that is
+    fitted and used exactly like the classifier itself
+    """
+    return make_pipeline(SparseReducer(**reducer_args), classifier)
+
+def matrix_digest(X):
+    """
+    A sha1 of the shape, dtype and contents of the sparse matrix X
+    """
+    X = sparse.csr_matrix(X)
+    h = hashlib.sha1(repr((X.shape, X.dtype.str)))
+    for array in (X.data, X.indices, X.indptr):
+        h.update(np.ascontiguousarray(array).data)
+    return h.hexdigest()
+
+def cached_reduction(X, path="reducer", **reducer_args):
+    """
+    Fits a SparseReducer on X and returns it along with the reduced X, both
+    pickled to path. If path already holds a reducer with the same settings
+    that was fitted on exactly the same matrix (same digest), that one is
+    loaded instead of refitting.
+    """
+    key = (sorted(reducer_args.items()), matrix_digest(X))
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            cached_key, reducer, X_reduced = pickle.load(f)
+        if cached_key == key:
+            return reducer, X_reduced
+    reducer = SparseReducer(**reducer_args).fit(X)
+    X_reduced = reducer.transform(X)
+    with open(path, "w") as f:
+        pickle.dump((key, reducer, X_reduced), f)
+    return reducer, X_reduced
@@ -0,0 +1,64 @@
+## Class balancing
+## ---------------
+## The None class makes up a big share of the training traces, so a model fit
+## on all of them spends most of its time on rows that look alike and learns
+## little about the rare families. Two remedies, usually used together:
+##
+##   subsample_majority - keeps at most max_ratio times the median class size
+##                        of every class, drawing the kept rows at random from
+##                        within each class (so the rare classes keep all of
+##                        theirs)
+##   class_weights      - weighs each class inversely to how many rows it has
+##                        left, so every class counts the same in the loss
+##
+## balance() does both and returns the rows to train on and their weights, to
+## pass as sample_weight to fit. Forests can instead use
+## class_weight="balanced_subsample", which reweighs the classes within each
+## tree's bootstrap sample.
+
+import numpy as np
+import util
+
+def class_counts(t, num_classes=None):
+    if num_classes is None:
+        num_classes = len(util.malware_classes)
+    return np.bincount(np.asarray(t), minlength=num_classes)
+
+def class_weights(t, power=1.0):
+    """
+    returns an array with the weight of each class: n / (classes present *
+    rows of the class), to the given power (0 for no reweighing, 1 for
+    fully balanced), or 0 for classes with no rows
+    """
+    counts = class_counts(t).astype(float)
+    present = counts > 0
+    weights = np.zeros(len(counts))
+    weights[present] = (counts.sum() / (present.sum() * counts[present])) ** power
+    return weights
+
+def subsample_majority(t, max_ratio=3.0, random_state=0):
+    """
+    returns the sorted positions of the rows of t to keep: every row of a
+    class with at most max_ratio times the median class size (over classes
+    present), and a random sample of that many rows of any bigger class
+    """
+    t = np.asarray(t)
+    counts = class_counts(t)
+    cap = max(1, int(max_ratio * np.median(counts[counts > 0])))
+    rng = np.random.RandomState(random_state)
+    keep = []
+    for clazz in np.flatnonzero(counts):
+        rows = np.flatnonzero(t == clazz)
+        if len(rows) > cap:
+            rows = rng.choice(rows, cap, replace=False)
+        keep.append(rows)
+    return np.sort(np.concatenate(keep))
+
+def balance(t, max_ratio=3.0, power=1.0, random_state=0):
+    """
+    returns the rows to train on (see subsample_majority) and the weight of
+    each of those rows (see class_weights, computed on the kept rows)
+    """
+    rows = subsample_majority(t, max_ratio, random_state)
+    kept = np.asarray(t)[rows]
+    return rows, class_weights(kept, power)[kept]
@@ -0,0 +1,205 @@
+## Size-aware extraction
+## ---------------------
+## Trace sizes are very skewed: most are small, a few are tens of MB. Handing
+## files out to workers in directory order means one worker can still be
+## parsing the largest trace well after the others are done. Here work is
+## handed out biggest first, one piece at a time, to whichever worker is free
+## (imap_unordered with chunksize 1), so the small files fill in around the big
+## ones.
+##
+## Traces bigger than split_bytes are also split into pieces. A piece is a run
+## of consecutive top-level <process> elements, picked so the pieces hold about
+## the same number of bytes. Each piece is parsed as its own document: the
+## header of the trace, the full text of its own processes, and an empty
+## <process .../> stub (same attributes, no threads) for every other process,
+## so the process tree (parents and depths) is the same in every piece. The
+## features of the pieces are then combined with each extractor's merge (see
+## merged_by in extractors.py). If any extractor has no merge, traces are never
+## split.
+##
+## extract_feats_parallel returns exactly what classifier.extract_feats does,
+## except that the segment features of a split trace (windowed_call_feats)
+## are rebuilt from its pieces' buckets, so they can put a few calls near a
+## segment boundary on the other side of it, within the same bound as for an
+## unsplit trace.
+
+import mmap
+import os
+import re
+from cStringIO import StringIO
+from itertools import imap
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+import numpy as np
+import extractors
+import fastparse
+import profiling
+import util
+
+# a top-level <process ...> start tag; attribute values may contain ">"
+PROCESS_TAG_RE = re.compile(r"""<process(?:\s+[^\s=>/]+\s*=\s*(?:"[^"]*"|'[^']*'))*\s*>""")
+PROCESSES_END = "</processes>"
+
+def splittable(ffs):
+    return all(hasattr(ff, "merge") for ff in ffs)
+
+def plan_splits(path, split_bytes):
+    """
+    Finds where the top-level processes of the trace at path start and end,
+    and groups them into runs of about split_bytes each.
+    returns:
+      None if the trace shouldn't be split, otherwise (spans, parts, header_end,
+      tail_start) where spans is a list of (start, tag_end, end) byte offsets
+      of each process and parts a list of (lo, hi) runs of positions in spans
+    """
+    size = os.path.getsize(path)
+    if size <= split_bytes:
+        return None
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            tail_start = data.rfind(PROCESSES_END)
+            tags = [(m.start(), m.end()) for m in PROCESS_TAG_RE.finditer(data, 0, tail_start)]
+        finally:
+            data.close()
+    if tail_start < 0 or len(tags) < 2:
+        return None
+    ends = [start for start, _ in tags[1:]] + [tail_start]
+    spans = [(start, tag_end, end) for (start, tag_end), end in zip(tags, ends)]
+    num_parts = min(len(spans), -(-size // split_bytes))
+    target = (tail_start - spans[0][0]) / float(num_parts)
+    parts = []
+    lo = 0
+    for i, (start, _, end) in enumerate(spans):
+        if end - spans[lo][0] >= target or i == len(spans) - 1:
+            parts.append((lo, i + 1))
+            lo = i + 1
+    return spans, parts, spans[0][0], tail_start
+
+def piece_document(data, spans, lo, hi, header_end, tail_start):
+    """
+    The text of a trace with only the processes in spans[lo:hi] in full and
+    every other process reduced to an empty stub
+    """
+    pieces = [data[:header_end]]
+    for i, (start, tag_end, end) in enumerate(spans):
+        if lo <= i < hi:
+            pieces.append(data[start:end])
+        else:
+            pieces.append(data[start:tag_end - 1] + "/>")
+    pieces.append(data[tail_start:])
+    return "".join(pieces)
+
+def _extract(task):
+    """
+    Runs the feature functions on one trace or one piece of one. Runs in a
+    worker process, so it has to be a module-level function.
+    returns (row, part, list of each ff's Counter)
+    """
+    ffs, path, row, part, split, parser = task
+    source = path
+    if split is not None:
+        spans, lo, hi, header_end, tail_start = split
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                source = StringIO(piece_document(data, spans, lo, hi, header_end, tail_start))
+            finally:
+                data.close()
+    if parser != "etree" and fastparse.streamable(ffs):
+        with profiling.stage("stream"):
+            return row, part, fastparse.stream_results(ffs, source, parser)
+    with profiling.stage("parse"):
+        tree = ET.parse(source)
+    with profiling.stage("extract"):
+        extractors.index_for(tree, ffs)
+        return row, part, [ff(tree) for ff in ffs]
+
+def plan_tasks(ffs, direc, directory, split_bytes, parser="etree"):
+    """
+    returns the _extract tasks for the files of directory, biggest first, and
+    the number of pieces each file was split into
+    """
+    can_split = split_bytes is not None and splittable(ffs)
+    tasks = []
+    num_parts = []
+    for row, datafile in enumerate(directory):
+        path = os.path.join(direc, datafile)
+        plan = plan_splits(path, split_bytes) if can_split else None
+        if plan is None:
+            tasks.append((os.path.getsize(path), (ffs, path, row, 0, None, parser)))
+            num_parts.append(1)
+            continue
+        spans, parts, header_end, tail_start = plan
+        for part, (lo, hi) in enumerate(parts):
+            size = spans[hi - 1][2] - spans[lo][0]
+            split = (spans, lo, hi, header_end, tail_start)
+            tasks.append((size, (ffs, path, row, part, split, parser)))
+        num_parts.append(len(parts))
+    tasks.sort(key=lambda task: -task[0])
+    return [task for _, task in tasks], num_parts
+
+def merge_parts(ffs, parts):
+    """
+    Combines the per-ff Counters of the pieces of one trace (in document
+    order) into the trace's feature dict
+    """
+    rowfd = {}
+    if len(parts) == 1:
+        [rowfd.update(c) for c in parts[0]]
+        return rowfd
+    for i, ff in enumerate(ffs):
+        rowfd.update(ff.merge([part[i] for part in parts]))
+    return rowfd
+
+def extract_feats_parallel(ffs, direc="train", global_feat_dict=None,
+                           processes=None, split_bytes=8 << 20, files=None,
+                           parser="etree", monitor=None):
+    """
+    arguments:
+      same as classifier.extract_feats (monitor included), and
+      processes is the number of worker processes (None for one per cpu, 1
+        to run everything in this process)
+      split_bytes is the size above which a trace is split into pieces (None
+        to never split)
+      parser is "etree", "expat" or "lxml" as for extract_feats
+    returns:
+      the same (X, feat_dict, t, ids) as classifier.extract_feats
+    """
+    from classifier import make_design_mat
+    with profiling.stage("list"):
+        directory = sorted(os.listdir(direc) if files is None else files)
+    ids = []
+    classes = []
+    for datafile in directory:
+        id_str, clazz = datafile.split('.')[:2]
+        ids.append(id_str)
+        classes.append(-1 if clazz == "X" else util.malware_classes.index(clazz))
+
+    tasks, num_parts = plan_tasks(ffs, direc, directory, split_bytes, parser)
+    results = [{} for _ in directory]
+    fds = [None] * len(directory)
+
+    def collect(done):
+        for row, part, counters in done:
+            results[row][part] = counters
+            if len(results[row]) == num_parts[row]:
+                fds[row] = merge_parts(ffs, [results[row][p] for p in xrange(num_parts[row])])
+                results[row] = None
+
+    if processes == 1:
+        collect(imap(_extract, tasks))
+    else:
+        pool = profiling.make_pool(processes)
+        try:
+            collect(pool.imap_unordered(_extract, tasks, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+            profiling.merge_workers()
+
+    with profiling.stage("design_matrix"):
+        X, feat_dict = make_design_mat(fds, global_feat_dict, monitor)
+    return X, feat_dict, np.array(classes), ids
@@ -0,0 +1,129 @@
+## Feature selection
+## -----------------
+## Most of the columns make_design_mat produces are one-off dll names, registry
+## paths and so on that say nothing about the class. FeatureSelector scores
+## every column against the malware classes and keeps the top k. All of the
+## per-class statistics it needs come out of a few sparse products of the
+## one-hot class matrix with X_train, so scoring is a single pass over the
+## nonzeros no matter how many columns there are.
+
+import numpy as np
+from scipy import sparse
+import util
+
+def class_stats(X, t, num_classes=len(util.malware_classes)):
+    """
+    arguments:
+      X is a sparse NxD design matrix, t the length N vector of class indices
+    returns:
+      a dict of per-class statistics of every column of X:
+        n       - number of rows in each class (length C)
+        sums    - C x D sums of each column over the rows of each class
+        sumsq   - C x D sums of squares
+        present - C x D number of rows in each class where the column is nonzero
+    """
+    X = sparse.csr_matrix(X)
+    N = X.shape[0]
+    Y = sparse.csr_matrix((np.ones(N), (np.asarray(t), np.arange(N))),
+                          shape=(num_classes, N))
+    X_sq = X.copy()
+    X_sq.data **= 2
+    X_bin = X.copy()
+    X_bin.data = (X_bin.data != 0).astype(float)
+    return {
+        "n": np.asarray(Y.sum(axis=1)).ravel(),
+        "sums": np.asarray(Y.dot(X).todense()),
+        "sumsq": np.asarray(Y.dot(X_sq).todense()),
+        "present": np.asarray(Y.dot(X_bin).todense()),
+    }
+
+def chi2_scores(stats):
+    """
+    Pearson's chi-squared statistic of each column's counts against the class
+    (the same statistic as sklearn.feature_selection.chi2)
+    """
+    observed = stats["sums"]
+    class_prob = stats["n"] / stats["n"].sum()
+    expected = np.outer(class_prob, observed.sum(axis=0))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = ((observed - expected) ** 2 / expected)
+    return np.nansum(scores, axis=0)
+
+def anova_f_scores(stats):
+    """
+    One-way ANOVA F statistic of each column across the classes
+    """
+    n = stats["n"]
+    used = n > 0
+    n, sums, sumsq = n[used], stats["sums"][used], stats["sumsq"][used]
+    N, C = n.sum(), len(n)
+    total_mean = sums.sum(axis=0) / N
+    class_means = sums / n[:, np.newaxis]
+    between = (n[:, np.newaxis] * (class_means - total_mean) ** 2).sum(axis=0)
+    within = sumsq.sum(axis=0) - (n[:, np.newaxis] * class_means ** 2).sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = (between / (C - 1)) / (within / (N - C))
+    scores[~np.isfinite(scores)] = 0.0
+    return scores
+
+def mutual_info_scores(stats):
+    """
+    Mutual information (in nats) between the class and whether each column is
+    nonzero
+    """
+    n = stats["n"][:, np.newaxis]
+    N = n.sum()
+    present = stats["present"]
+    scores = np.zeros(present.shape[1])
+    for joint in (present, n - present):
+        p_joint = joint / N
+        p_feat = joint.sum(axis=0) / N
+        with np.errstate(divide="ignore", invalid="ignore"):
+            terms = p_joint * np.log(p_joint / ((n / N) * p_feat))
+        scores += np.nansum(terms, axis=0)
+    return scores
+
+score_funcs = {
+    "chi2": chi2_scores,
+    "f": anova_f_scores,
+    "mi": mutual_info_scores,
+}
+
+class FeatureSelector(object):
+    """
+    Keeps the k columns of the design matrix that score highest under score,
+    one of "chi2", "f" or "mi". After fitting, columns holds the kept column
+    numbers in increasing order and scores the score of every column.
+    """
+    def __init__(self, k=10000, score="chi2"):
+        if score not in score_funcs:
+            raise ValueError("Unknown feature score: %s" % score)
+        self.k = k
+        self.score = score
+        self.columns = None
+        self.scores = None
+
+    def fit(self, X, t):
+        self.scores = score_funcs[self.score](class_stats(X, t))
+        if self.k >= len(self.scores):
+            self.columns = np.arange(len(self.scores))
+        else:
+            top = np.argpartition(-self.scores, self.k - 1)[:self.k]
+            self.columns = np.sort(top)
+        return self
+
+    def transform(self, X):
+        return sparse.csr_matrix(X)[:, self.columns]
+
+    def fit_transform(self, X, t):
+        return self.fit(X, t).transform(X)
+
+    def reduce_feat_dict(self, feat_dict):
+        """
+        Returns a copy of feat_dict holding only the kept features, renumbered
+        to match the columns of transform(X). Extracting test features with
+        it drops the rest of the columns up front.
+        """
+        new_col = dict((col, i) for i, col in enumerate(self.columns))
+        return dict((feat, new_col[col]) for feat, col in feat_dict.iteritems()
+                    if col in new_col)
@@ -0,0 +1,104 @@
+## Sharded design matrices
+## -----------------------
+## make_design_mat builds one matrix and one vocabulary from every feature dict
+## at once. The functions here instead work on blocks: (X, feat_dict) pairs
+## built separately, each with its own local vocabulary (column numbering).
+## Blocks are reconciled by remapping column indices, which only ever touches
+## the vocabulary in python; the nonzeros themselves are moved with a single
+## vectorized numpy lookup per block.
+##
+##   merge_design_mats  - combine blocks into one matrix over the union
+##                        vocabulary (numbered like make_design_mat would)
+##   append_design_mat  - add a block of new rows to an existing matrix,
+##                        keeping every existing column number, so the old
+##                        matrix is reused as-is
+##   remap_columns      - renumber a block onto a given vocabulary, dropping
+##                        features it doesn't have (e.g. for test data)
+
+import numpy as np
+from scipy import sparse
+
+def column_map(feat_dict, target_feat_dict):
+    """
+    returns an array mapping each column of feat_dict to the column of the
+    same feature in target_feat_dict, or -1 if the feature isn't there
+    """
+    remap = np.empty(len(feat_dict), dtype=np.int64)
+    remap.fill(-1)
+    for feat, col in feat_dict.iteritems():
+        remap[col] = target_feat_dict.get(feat, -1)
+    return remap
+
+def remap_columns(X, feat_dict, target_feat_dict):
+    """
+    Renumbers the columns of X (whose vocabulary is feat_dict) to those of
+    target_feat_dict. Nonzeros of features missing from target_feat_dict are
+    dropped. returns a CSR matrix with len(target_feat_dict) columns.
+    """
+    X = sparse.csr_matrix(X)
+    remap = column_map(feat_dict, target_feat_dict)
+    cols = remap[X.indices]
+    kept = cols >= 0
+    if kept.all():
+        indptr = X.indptr
+        data = X.data
+    else:
+        # count the surviving nonzeros of each row to rebuild indptr
+        rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+        per_row = np.bincount(rows[kept], minlength=X.shape[0])
+        indptr = np.concatenate([[0], np.cumsum(per_row)])
+        cols = cols[kept]
+        data = X.data[kept]
+    out = sparse.csr_matrix((data, cols, indptr),
+                            shape=(X.shape[0], len(target_feat_dict)))
+    out.sort_indices()
+    return out
+
+def merge_design_mats(blocks):
+    """
+    arguments:
+      blocks is a list of (X, feat_dict) pairs with local vocabularies
+    returns:
+      the rows of every block stacked in order, over the sorted union of the
+      vocabularies, and that union as a feat_dict
+    """
+    all_feats = set()
+    for _, feat_dict in blocks:
+        all_feats.update(feat_dict)
+    global_feat_dict = dict((feat, i) for i, feat in enumerate(sorted(all_feats)))
+    X = sparse.vstack([remap_columns(X, feat_dict, global_feat_dict)
+                       for X, feat_dict in blocks]).tocsr()
+    return X, global_feat_dict
+
+def extend_vocabulary(feat_dict, new_feats):
+    """
+    returns a copy of feat_dict with the features of new_feats it doesn't
+    have yet added after its existing columns, in sorted order
+    """
+    extended = dict(feat_dict)
+    for feat in sorted(set(new_feats).difference(feat_dict)):
+        extended[feat] = len(extended)
+    return extended
+
+def widen(X, num_cols):
+    """
+    X with extra empty columns on the right, sharing X's arrays
+    """
+    X = sparse.csr_matrix(X)
+    return sparse.csr_matrix((X.data, X.indices, X.indptr),
+                             shape=(X.shape[0], num_cols), copy=False)
+
+def append_design_mat(X, feat_dict, X_new, new_feat_dict):
+    """
+    arguments:
+      X, feat_dict is an existing matrix and its vocabulary
+      X_new, new_feat_dict is a block of new rows with its local vocabulary
+    returns:
+      the rows of X followed by the rows of X_new, and the extended
+      vocabulary. Every feature keeps its column from feat_dict; features only
+      X_new has get new columns at the end, so nothing already in X moves.
+    """
+    extended = extend_vocabulary(feat_dict, new_feat_dict)
+    X = widen(X, len(extended))
+    X_new = remap_columns(X_new, new_feat_dict, extended)
+    return sparse.vstack([X, X_new]).tocsr(), extended
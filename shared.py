@@ -0,0 +1,125 @@
+## Shared training matrices
+## ------------------------
+## Handing a design matrix to worker processes the usual way pickles a full
+## copy of it into every task, so peak memory grows with the number of models
+## trained at once. SharedMatrix instead writes the matrix's arrays (data,
+## indices, indptr) to .npy files once; workers get only the small handle and
+## memory-map the arrays read-only, so every worker reads the same pages of
+## the page cache and nothing is copied until a model converts the matrix
+## itself.
+##
+## Models convert what they are given into the format they want: logistic
+## regression (liblinear) uses CSR float64 as is, while a forest makes its own
+## CSC float32 copy. So by default train_models shares one copy in each format
+## its models want (preferred_format): CSC float32 for the trees, CSR float64
+## for the rest, and no forest makes a copy of its own. (liblinear still
+## builds its own problem from the CSR rows, which no sharing can avoid.)
+##
+##   fitted = shared.train_models([RandomForestClassifier(...),
+##                                 LogisticRegression(...)], X, t)
+
+import os
+import shutil
+import tempfile
+import numpy as np
+from scipy import sparse
+from sklearn.base import clone
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+from sklearn.tree import DecisionTreeClassifier
+import profiling
+
+class SharedMatrix(object):
+    """
+    A picklable handle on a sparse matrix stored as .npy files in directory
+    """
+    def __init__(self, directory, fmt, shape):
+        self.directory = directory
+        self.fmt = fmt
+        self.shape = shape
+
+    @classmethod
+    def create(cls, X, fmt="csr", dtype=None, directory=None):
+        """
+        Writes X (converted to fmt and dtype) into directory, a fresh temporary
+        directory by default, and returns its handle
+        """
+        X = X.tocsc() if fmt == "csc" else sparse.csr_matrix(X)
+        if dtype is not None:
+            X = X.astype(dtype)
+        # models sort indices in place, which a read-only map can't do
+        X.sort_indices()
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="shared-matrix-")
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(directory, name + ".npy"), getattr(X, name))
+        return cls(directory, fmt, X.shape)
+
+    def load(self):
+        """
+        The matrix, backed by read-only memory maps of the files
+        """
+        arrays = [np.load(os.path.join(self.directory, name + ".npy"), mmap_mode="r")
+                  for name in ("data", "indices", "indptr")]
+        matrix = sparse.csc_matrix if self.fmt == "csc" else sparse.csr_matrix
+        X = matrix(tuple(arrays), shape=self.shape, copy=False)
+        X.has_sorted_indices = True
+        return X
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def _fit_shared(task):
+    """
+    Fits one model on the shared matrix. Runs in a worker process.
+    """
+    model, shared, t, rows = task
+    X = shared.load()
+    if rows is not None:
+        X, t = X[rows], t[rows]
+    with profiling.stage("fit"):
+        return model.fit(X, t)
+
+def preferred_format(model):
+    """
+    The (fmt, dtype) model converts its training matrix to when fitting
+    """
+    if isinstance(model, (RandomForestClassifier, ExtraTreesClassifier,
+                          DecisionTreeClassifier)):
+        return "csc", np.float32
+    return "csr", None
+
+def train_models(models, X, t, rows=None, processes=None, fmt=None, dtype=None):
+    """
+    arguments:
+      models is a list of unfitted classifiers (model configurations)
+      X, t are the training matrix and targets, shared by every model
+      rows optionally restricts training to those rows of X
+      processes is the number of worker processes (None for one per cpu)
+      fmt and dtype are the format ("csr" or "csc") and dtype X is shared as;
+        by default each model gets its preferred_format, with one shared copy
+        of X per format
+    returns:
+      the fitted models, in order
+    """
+    t = np.asarray(t)
+    formats = [(fmt, dtype) if fmt is not None else preferred_format(model)
+               for model in models]
+    shared = {}
+    try:
+        for form in formats:
+            if form not in shared:
+                shared[form] = SharedMatrix.create(X, *form)
+        tasks = [(clone(model), shared[form], t, rows)
+                 for model, form in zip(models, formats)]
+        if processes == 1 or len(tasks) == 1:
+            return map(_fit_shared, tasks)
+        pool = profiling.make_pool(processes)
+        try:
+            return pool.map(_fit_shared, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            profiling.merge_workers()
+    finally:
+        for matrix in shared.values():
+            matrix.remove()
@@ -0,0 +1,121 @@
+## Feature transforms
+## ------------------
+## The raw counts coming out of the extractors are on wildly different scales:
+## a trace with millions of calls dwarfs everything else in its row, and
+## num_system_calls sits orders of magnitude above the 0/1 first_call-*
+## features. FeatureTransform is fitted once on the training matrix, pickled
+## next to global_feat_dict, and then applied the same way to every matrix
+## built with that vocabulary. Everything works directly on the .data array
+## of a CSR matrix, so nothing ever gets densified.
+
+import numpy as np
+from scipy import sparse
+
+class FeatureTransform(object):
+    """
+    A fitted chain of sparse transforms, applied in this order:
+      log1p  - replace each count x with log(1 + x)
+      tfidf  - scale each column by its smoothed inverse document frequency,
+               log((1 + N) / (1 + df)) + 1
+      maxabs - scale each column so its largest absolute value is 1
+      l2     - scale each row to unit euclidean length
+    Each step can be turned off by passing False for it.
+    """
+    def __init__(self, log1p=True, tfidf=True, maxabs=False, l2=True):
+        self.log1p = log1p
+        self.tfidf = tfidf
+        self.maxabs = maxabs
+        self.l2 = l2
+        self.n_features = None
+        self.idf = None
+        self.scale = None
+        # raw column statistics, kept so partial_fit can add rows to them
+        self.n_rows = 0
+        self.df = None
+        self.raw_max = None
+
+    def fit(self, X):
+        """
+        Learns the column statistics (document frequencies and max-abs
+        values) from the training matrix X. returns self.
+        """
+        self.n_features = None
+        self.n_rows = 0
+        self.df = None
+        self.raw_max = None
+        return self.partial_fit(X)
+
+    def partial_fit(self, X):
+        """
+        Adds the rows of X to the column statistics, as if we had been fitted
+        on every row at once. X may have extra columns on the right (features
+        new since the last fit, see shards.append_design_mat); the transform
+        then covers those too. returns self.
+        """
+        if self.n_features is not None and getattr(self, "df", None) is None:
+            raise ValueError("This FeatureTransform can't be updated; fit it again")
+        X = sparse.csr_matrix(X)
+        n, d = X.shape
+        if self.n_features is not None and d < self.n_features:
+            raise ValueError("Expected at least %d features but got %d"
+                             % (self.n_features, d))
+        df = np.bincount(X.indices[X.data != 0], minlength=d)
+        colmax = np.zeros(d)
+        np.maximum.at(colmax, X.indices, np.abs(X.data))
+        if self.df is not None:
+            df[:len(self.df)] += self.df
+            colmax[:len(self.raw_max)] = np.maximum(colmax[:len(self.raw_max)], self.raw_max)
+        self.n_rows += n
+        self.n_features = d
+        self.df = df
+        self.raw_max = colmax
+        if self.tfidf:
+            self.idf = np.log((1.0 + self.n_rows) / (1.0 + df)) + 1.0
+        if self.maxabs:
+            # log1p and the idf weights are monotone, so the max of the
+            # transformed column is the transform of the raw max
+            if self.log1p:
+                colmax = np.log1p(colmax)
+            if self.tfidf:
+                colmax = colmax * self.idf
+            colmax[colmax == 0] = 1.0
+            self.scale = colmax
+        return self
+
+    def transform(self, X, inplace=False):
+        """
+        Applies the fitted transforms to X, which must have the columns of the
+        matrix we were fitted on. With inplace=True the data array of X (which
+        must then be a float CSR matrix) is overwritten instead of copied.
+        returns the transformed CSR matrix.
+        """
+        if self.n_features is None:
+            raise ValueError("FeatureTransform has not been fitted")
+        if X.shape[1] != self.n_features:
+            raise ValueError("Expected %d features but got %d"
+                             % (self.n_features, X.shape[1]))
+        if not sparse.isspmatrix_csr(X) or X.dtype.kind != "f":
+            if inplace:
+                raise ValueError("inplace transforms need a float CSR matrix")
+            X = sparse.csr_matrix(X, dtype=float)
+        elif not inplace:
+            X = X.copy()
+        data = X.data
+        if self.log1p:
+            # keep the sign so the odd negative value doesn't turn into a nan
+            np.copysign(np.log1p(np.abs(data)), data, out=data)
+        if self.tfidf:
+            data *= self.idf[X.indices]
+        if self.maxabs:
+            data /= self.scale[X.indices]
+        if self.l2:
+            row_lengths = np.diff(X.indptr)
+            rows = np.repeat(np.arange(X.shape[0]), row_lengths)
+            norms = np.sqrt(np.bincount(rows, weights=data ** 2,
+                                        minlength=X.shape[0]))
+            norms[norms == 0] = 1.0
+            data /= norms[rows]
+        return X
+
+    def fit_transform(self, X, inplace=False):
+        return self.fit(X).transform(X, inplace=inplace)
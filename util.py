@@ -1,3 +1,8 @@
+import os
+import json
+import numpy as np
+import profiling
+
 # these are the fifteen malware classes we're looking for
 malware_classes = ["Agent", "AutoRun", "FraudLoad", "FraudPack", "Hupigon", "Krap",
            "Lipler", "Magania", "None", "Poison", "Swizzor", "Tdss",
@@ -7,12 +12,227 @@ malware_classes = ["Agent", "AutoRun", "FraudLoad", "FraudPack", "Hupigon", "Kra
 def write_predictions(predictions, ids, outfile):
     """
     assumes len(predictions) == len(ids), and that predictions[i] is the
-    index of the predicted class with the malware_classes list above for 
+    index of the predicted class with the malware_classes list above for
     the executable corresponding to ids[i].
     outfile will be overwritten
     """
-    with open(outfile,"w+") as f:
-        # write header
-        f.write("Id,Prediction\n")
-        for i, history_id in enumerate(ids):
-            f.write("%s,%d\n" % (history_id, predictions[i]))
\ No newline at end of file
+    with PredictionWriter(outfile) as writer:
+        writer.write(ids, predictions)
+
+class PredictionWriter(object):
+    """
+    Streams predictions out in chunks so a scoring run never has to hold all
+    of its predictions in memory. Rows are buffered until chunk_size of them
+    have been written, then flushed in one go.
+
+    fmt is one of:
+      "csv"      - the Kaggle submission format, Id,Prediction[,Class][,prob-*]
+      "jsonl"    - one json object per line
+      "columnar" - outfile is a directory holding one compressed .npz per chunk
+                   (like a parquet row group), with one array per column
+
+    class_names adds the name from malware_classes next to each prediction,
+    probabilities adds one prob-<class> column per malware class (the caller
+    then has to pass probas to write()).
+    """
+    formats = ("csv", "jsonl", "columnar")
+
+    def __init__(self, outfile, fmt="csv", class_names=False,
+                 probabilities=False, chunk_size=1000):
+        if fmt not in self.formats:
+            raise ValueError("Unknown prediction format: %s" % fmt)
+        self.outfile = outfile
+        self.fmt = fmt
+        self.class_names = class_names
+        self.probabilities = probabilities
+        self.chunk_size = chunk_size
+        self.rows_written = 0
+        self._chunks_written = 0
+        self._ids = []
+        self._preds = []
+        self._probas = []
+        self._f = None
+
+        if fmt == "columnar":
+            if not os.path.isdir(outfile):
+                os.makedirs(outfile)
+            # outfile will be overwritten
+            for name in os.listdir(outfile):
+                if name.startswith("part-") and name.endswith(".npz"):
+                    os.remove(os.path.join(outfile, name))
+        else:
+            self._f = open(outfile, "w+")
+            if fmt == "csv":
+                self._f.write(",".join(self.columns()) + "\n")
+
+    def columns(self):
+        """
+        Names of the columns written for each row, in order
+        """
+        cols = ["Id", "Prediction"]
+        if self.class_names:
+            cols.append("Class")
+        if self.probabilities:
+            cols.extend(["prob-" + clazz for clazz in malware_classes])
+        return cols
+
+    def write(self, ids, predictions, probas=None):
+        """
+        Buffers a batch of predictions, flushing whenever a full chunk has
+        accumulated. probas should be a len(ids) x len(malware_classes) array
+        if the writer was created with probabilities=True.
+        """
+        assert len(ids) == len(predictions)
+        if self.probabilities:
+            if probas is None:
+                raise ValueError("This writer needs class probabilities")
+            probas = np.asarray(probas, dtype=float)
+            assert probas.shape == (len(ids), len(malware_classes))
+        start = 0
+        while start < len(ids):
+            room = self.chunk_size - len(self._ids)
+            stop = min(len(ids), start + room)
+            self._ids.extend(ids[start:stop])
+            self._preds.extend(int(p) for p in predictions[start:stop])
+            if self.probabilities:
+                self._probas.append(probas[start:stop])
+            if len(self._ids) >= self.chunk_size:
+                self.flush()
+            start = stop
+
+    def flush(self):
+        """
+        Writes out whatever is buffered
+        """
+        if not self._ids:
+            return
+        if self.probabilities:
+            probas = np.vstack(self._probas)
+        else:
+            probas = None
+        if self.fmt == "csv":
+            self._write_csv(probas)
+        elif self.fmt == "jsonl":
+            self._write_jsonl(probas)
+        else:
+            self._write_columnar(probas)
+        self.rows_written += len(self._ids)
+        self._chunks_written += 1
+        self._ids = []
+        self._preds = []
+        self._probas = []
+
+    def close(self):
+        self.flush()
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_csv(self, probas):
+        lines = []
+        for i, history_id in enumerate(self._ids):
+            fields = ["%s" % history_id, "%d" % self._preds[i]]
+            if self.class_names:
+                fields.append(malware_classes[self._preds[i]])
+            if self.probabilities:
+                fields.extend("%.6f" % p for p in probas[i])
+            lines.append(",".join(fields))
+        self._f.write("\n".join(lines) + "\n")
+
+    def _write_jsonl(self, probas):
+        lines = []
+        for i, history_id in enumerate(self._ids):
+            row = {"Id": history_id, "Prediction": self._preds[i]}
+            if self.class_names:
+                row["Class"] = malware_classes[self._preds[i]]
+            if self.probabilities:
+                row["Probabilities"] = dict(zip(malware_classes,
+                                                probas[i].tolist()))
+            lines.append(json.dumps(row, sort_keys=True))
+        self._f.write("\n".join(lines) + "\n")
+
+    def _write_columnar(self, probas):
+        preds = np.array(self._preds, dtype=np.int32)
+        cols = {"Id": np.array(self._ids), "Prediction": preds}
+        if self.class_names:
+            cols["Class"] = np.array(malware_classes)[preds]
+        if self.probabilities:
+            for k, clazz in enumerate(malware_classes):
+                cols["prob-" + clazz] = probas[:, k]
+        path = os.path.join(self.outfile, "part-%05d.npz" % self._chunks_written)
+        np.savez_compressed(path, **cols)
+
+def read_columnar_predictions(outdir):
+    """
+    Reads back a directory written by PredictionWriter(fmt="columnar") and
+    returns a dict mapping column name to a numpy array of all rows
+    """
+    parts = sorted(name for name in os.listdir(outdir)
+                   if name.startswith("part-") and name.endswith(".npz"))
+    cols = {}
+    for name in parts:
+        with np.load(os.path.join(outdir, name)) as part:
+            for col in part.files:
+                cols.setdefault(col, []).append(part[col])
+    return dict((col, np.concatenate(chunks)) for col, chunks in cols.items())
+
+def stream_predictions(model, X, ids, outfile, chunk_size=1000, **writer_args):
+    """
+    Scores the rows of X chunk_size at a time with model.predict (and
+    model.predict_proba if the writer wants probabilities) and streams each
+    chunk to outfile as soon as it is scored, so predictions never pile up in
+    memory. Scoring and writing are profiled as the "predict" and "write"
+    stages. Any other keyword arguments are passed on to PredictionWriter.
+
+    returns the number of rows written
+    """
+    with profiling.stage("write"):
+        writer = PredictionWriter(outfile, chunk_size=chunk_size, **writer_args)
+    try:
+        for start in xrange(0, X.shape[0], chunk_size):
+            X_chunk = X[start:start + chunk_size]
+            chunk_ids = ids[start:start + chunk_size]
+            with profiling.stage("predict"):
+                # the labels are always the model's own predictions (which
+                # needn't be the argmax of its probabilities, say for a
+                # cascade); probabilities only fill the extra columns
+                preds = class_indices(model.predict(X_chunk))
+                probas = None
+                if writer.probabilities:
+                    probas = full_probas(model, model.predict_proba(X_chunk))
+            with profiling.stage("write"):
+                writer.write(chunk_ids, preds, probas)
+    finally:
+        with profiling.stage("write"):
+            writer.close()
+    return writer.rows_written
+
+def class_indices(labels):
+    """
+    The indices into malware_classes of labels, which may be indices already
+    or class names
+    """
+    labels = np.asarray(labels)
+    if labels.dtype.kind in "SUO":
+        return np.array([malware_classes.index(label) if isinstance(label, basestring)
+                         else int(label) for label in labels], dtype=int)
+    return labels.astype(int)
+
+def full_probas(model, probas):
+    """
+    sklearn only returns probabilities for the classes it saw while fitting,
+    in the order of model.classes_ (indices or class names), so spread them
+    out to one column per malware class
+    """
+    classes = class_indices(getattr(model, "classes_", np.arange(probas.shape[1])))
+    if probas.shape[1] == len(malware_classes) and (classes == np.arange(len(classes))).all():
+        return probas
+    full = np.zeros((probas.shape[0], len(malware_classes)))
+    full[:, classes] = probas
+    return full